@@ -1,13 +1,59 @@
+import asyncio
+import math
+import os
+import sys
 import uvicorn
-from fastapi import FastAPI, Request
-import pandas as pd
-from pydantic import BaseModel
-from typing import Literal, List, Union
-import joblib
-from model_definition import SVR_with_InverseScaler 
+from contextlib import asynccontextmanager
+from fastapi import Depends, FastAPI, Header, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import Any, Literal, List, Optional, Union
+from model_registry import registry
+from micro_batcher import MicroBatcher
+from prediction_cache import cache_key, prediction_cache
+from executor import Overloaded, executor
+from instrumentation import PROFILING, MetricsMiddleware, metrics, render_prometheus, sample_stacks
 
-import __main__
-__main__.SVR_with_InverseScaler = SVR_with_InverseScaler 
+# maximum number of cars accepted by /predict/batch, and number of rows scored at once
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "10000"))
+BATCH_CHUNK_SIZE = int(os.environ.get("BATCH_CHUNK_SIZE", "1000"))
+
+# optional grouping of concurrent /predict calls into one model call
+MICRO_BATCHING = os.environ.get("MICRO_BATCHING", "0") == "1"
+MICRO_BATCH_WAIT_MS = float(os.environ.get("MICRO_BATCH_WAIT_MS", "5"))
+MICRO_BATCH_MAX_SIZE = int(os.environ.get("MICRO_BATCH_MAX_SIZE", "64"))
+# cars waiting to be batched before new /predict requests get a 429
+MICRO_BATCH_MAX_PENDING = int(os.environ.get("MICRO_BATCH_MAX_PENDING", "256"))
+
+# rows returned by the search endpoints when no limit is given, and the largest limit accepted
+SEARCH_DEFAULT_LIMIT = int(os.environ.get("SEARCH_DEFAULT_LIMIT", "100"))
+SEARCH_MAX_LIMIT = int(os.environ.get("SEARCH_MAX_LIMIT", "10000"))
+
+# seconds an endpoint waits for its blocking work before answering 504
+PREDICT_TIMEOUT = float(os.environ.get("PREDICT_TIMEOUT", "5"))
+BATCH_TIMEOUT = float(os.environ.get("BATCH_TIMEOUT", "60"))
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", "30"))
+POLICY_TIMEOUT = float(os.environ.get("POLICY_TIMEOUT", "30"))
+RELOAD_TIMEOUT = float(os.environ.get("RELOAD_TIMEOUT", "120"))
+
+# errors of the executor answered by the 429 and 504 handlers instead of the {"error": ...} of the endpoints
+BUSY = (Overloaded, asyncio.TimeoutError)
+
+
+def pricing_table():
+    # imported by the first search: pandas is not loaded at the start of the workers, only scikit-learn for the model
+    from pricing_data import pricing_data
+    return pricing_data.get()
+
+
+def get_delay_policies():
+    # imported by the first /policy/evaluate, with the delay data modules of the dashboard
+    from delay_policies import delay_policies
+    return delay_policies
+
+
+def evaluate_rows(policies):
+    return get_delay_policies().evaluate(policies)
 
 
 # description will apear in the doc
@@ -23,7 +69,7 @@ Trained on a dataset of 4,843 rentals, the goal of Getaround API is designed to
 our users to achieve an indicative estimatation of daily rental revenue of their vehicles.
 \n\n
 
-The API has 3 groups of endpoints: \n
+The API has 5 groups of endpoints: \n
 
 ## Introduction Endpoints \n
 - **/**: the greeting page that directs you to the API documentation \n
@@ -33,9 +79,41 @@ The API has 3 groups of endpoints: \n
 - **/search_model/{model_key}** : a **GET** request to retrieve data for a car model you select \n
 - **/search_type/{car_type}** : a **GET** request to retrieve data for a car type you select \n
 - **/search_fuel/{fuel}** : a **GET** request to retrieve data for the fuel type you select \n
+- **/search** : a **GET** request to retrieve data matching any combination of filters, or aggregates of the prices of those cars \n
+\n
+The search endpoints return one page of the results, set by the optional query parameters `limit` (100 rows by
+default, at most 10000) and `offset` (the total number of matching rows is returned in the
+`X-Total-Count` header), `fields` to keep only some columns
+(e.g. `fields=model_key,mileage,rental_price_per_day`) and `stream=ndjson` or `stream=csv` to receive the rows
+as a stream of JSON lines or CSV instead of one JSON object.
+\n
+**/preview** and the search endpoints also return the rows as a list of records (`format=records`), in the Apache Arrow
+IPC stream format (`format=arrow`, or the header `Accept: application/vnd.apache.arrow.stream`) or as a Parquet
+file (`format=parquet`, or `Accept: application/vnd.apache.parquet`), to be read straight into a DataFrame:
+`pyarrow.ipc.open_stream(response.content).read_pandas()` or `pandas.read_parquet(io.BytesIO(response.content))`.
 \n
 ## AI Solutions Endpoints
 - **/predict**: returns the predicted price of a car based on the information you provide
+- **/predict/batch**: returns the predicted prices of a list of cars in one request
+\n
+## Delay Policy Endpoints
+- **/policy/evaluate**: outcomes of minimum delays between two rentals (threshold, scope and customer flexibility),
+computed on the rentals of the delay analysis like the curves of the dashboard
+\n
+## Operations Endpoints
+- **/ready**: tells whether the model is loaded and the API can serve predictions \n
+- **/model/reload**: a **POST** request to load a new version of the model files without restarting the server \n
+- **/metrics/batcher**: statistics of the micro-batching of **/predict** requests, when it is enabled \n
+- **/metrics/cache**: hit, miss and eviction counters of the cache of **/predict** results
+- **/metrics/policy**: version of the delay data and counters of the memoized **/policy/evaluate** results
+- **/metrics/executor**: threads, pending tasks, rejected and timed out requests of the executor running the blocking work
+- **/metrics**: all the metrics in the Prometheus text format; with `METRICS=1` it also has the latency of each endpoint,
+the time spent in each stage of **/predict** and of the searches, and the requests in flight
+- **/debug/profile**: with `PROFILING=1`, samples the stacks of the worker for a few seconds and returns them in the folded
+format of flame graphs
+\n
+The blocking work of the endpoints (reading data, scoring cars) runs in a bounded pool of threads: when too many
+requests are in progress the API answers **429** (retry later), and a request taking too long gets a **504**.
 
 
 """
@@ -54,10 +132,33 @@ tags_metadata = [
     {
         "name": "AI Solutions Endpoints",
         "description": "Prediction Endpoint that deals with **POST** requests."
+    },
+
+    {
+        "name": "Delay Policy Endpoints",
+        "description": "Counterfactual outcomes of a minimum delay between two rentals, with **POST** requests."
+    },
+
+    {
+        "name": "Operations Endpoints",
+        "description": "Health and model management endpoints."
     }
 ]
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the model & preprocessor once, they are then shared by all requests of this worker
+    # (already done when gunicorn preloads the app, see gunicorn.conf.py)
+    if not registry.ready:
+        registry.load()
+    if batcher is not None:
+        batcher.start()
+    yield
+    if batcher is not None:
+        await batcher.stop()
+
+
 app = FastAPI(
     title="Getaround API",
     description=description,
@@ -67,7 +168,30 @@ app = FastAPI(
         "url": "https://github.com/yhaslan",
     },
     #openapi_tags=tags_metadata
+    lifespan=lifespan
 )
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(status_code=429, content={"error": str(exc)}, headers={"Retry-After": "1"})
+
+
+@app.exception_handler(asyncio.TimeoutError)
+async def timeout_handler(request: Request, exc: asyncio.TimeoutError):
+    return JSONResponse(status_code=504, content={"error": "The request took too long to be processed"})
+
+
+async def run_blocking(func, *args, timeout):
+    """Run func in the executor, its errors are returned as {"error": ...} like in the other endpoints"""
+    try:
+        return await executor.run(func, *args, timeout=timeout)
+    except BUSY:
+        raise
+    except Exception as e:
+        return {"error": str(e)}
+
 
 @app.get("/", tags=["Introduction Endpoints"])
 async def root():
@@ -75,19 +199,123 @@ async def root():
     To discover more on car-sharing and rental price optimization, check out documentation of the api at `/docs`."""
     return message
 
+# formats of the rows of /preview and of the searches, and the media types requesting them in an Accept header
+ROW_FORMATS = {
+    "json": "application/json",  # {column: {row: value}}, the default
+    "records": "application/json",  # [{column: value}]
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+ACCEPTED_FORMATS = {"application/vnd.apache.arrow.stream": "arrow", "application/vnd.apache.arrow.file": "arrow",
+                    "application/vnd.apache.parquet": "parquet", "application/x-parquet": "parquet"}
+
+
+def row_format(format: Optional[Literal["json", "records", "arrow", "parquet"]] =
+               Query(None, description="Format of the rows, overrides the Accept header"),
+               accept: Optional[str] = Header(None, include_in_schema=False)):
+    """Format asked with the format parameter, else the first Arrow or Parquet media type of the Accept header"""
+    if format is not None:
+        return format
+    for media_type in (accept or "").split(","):
+        media_type = media_type.split(";")[0].strip().lower()
+        if media_type in ACCEPTED_FORMATS:
+            return ACCEPTED_FORMATS[media_type]
+    return "json"
+
+
+def encode_rows(data, positions, offset=0, limit=None, fields=None, format="json", t=0.0, operation="search"):
+    """
+    Body of a page of rows in the given format, serialized from the columns of the table without building
+    Python dicts: pandas' JSON encoder for the JSON formats, pyarrow writers for Arrow and Parquet.
+    """
+    if format in ("arrow", "parquet"):
+        import pyarrow as pa
+        table = data.arrow_rows(positions, offset, limit, fields)
+        t = metrics.lap(operation, "rows", t)
+        sink = pa.BufferOutputStream()
+        if format == "arrow":
+            with pa.ipc.new_stream(sink, table.schema) as writer:
+                writer.write_table(table)
+        else:
+            import pyarrow.parquet as pq
+            pq.write_table(table, sink)
+        content = sink.getvalue().to_pybytes()
+    else:
+        rows = data.rows(positions, offset, limit, fields)
+        t = metrics.lap(operation, "rows", t)
+        orient = "records" if format == "records" else "columns"
+        content = rows.to_json(orient=orient, force_ascii=False, double_precision=15)
+    metrics.lap(operation, "serialize", t)
+    return content
+
+
 @app.get("/preview", tags=["Introduction Endpoints"])
-async def print_samples():
+async def print_samples(format: str = Depends(row_format)):
     """
     display 10 random examples from the dataset
 
     """
-    data = pd.read_csv("https://jedha-getaround-project.s3.amazonaws.com/pricing_data_cleaned.csv")
-    sample = data.sample(10)
+    return await run_blocking(preview_rows, format, timeout=SEARCH_TIMEOUT)
+
+
+def preview_rows(format):
+    data = pricing_table()
+    content = encode_rows(data, data.sample(10), format=format, t=metrics.clock(), operation="preview")
+    return Response(content, media_type=ROW_FORMATS[format])
+
+class Page:
+    """Pagination, projection, streaming and format options shared by the search endpoints"""
+    def __init__(self,
+                 limit: int = Query(SEARCH_DEFAULT_LIMIT, ge=1, le=SEARCH_MAX_LIMIT,
+                                    description="Maximum number of rows to return"),
+                 offset: int = Query(0, ge=0, description="Number of matching rows to skip"),
+                 fields: Optional[str] = Query(None, description="Comma separated list of columns to return"),
+                 stream: Optional[Literal["ndjson", "csv"]] = Query(None, description="Stream the rows in this format"),
+                 format: str = Depends(row_format)):
+        self.limit = limit
+        self.offset = offset
+        self.fields = fields.split(",") if fields else None
+        self.stream = stream
+        self.format = format
+
+
+def stream_rows(blocks, stream):
+    """Serialize the blocks of rows one at a time, as JSON lines or as CSV with a single header"""
+    header = True
+    for block in blocks:
+        if stream == "ndjson":
+            yield block.to_json(orient="records", lines=True, force_ascii=False)
+        else:
+            yield block.to_csv(index=False, header=header)
+            header = False
+
+
+def search_response(data, positions, page, t=0.0):
+    data.columns(page.fields)  # fail before streaming starts if a field does not exist
+    if page.stream is not None:
+        if page.format in ("arrow", "parquet"):
+            raise ValueError(f"stream={page.stream} can not be used with the {page.format} format")
+        media_type = "application/x-ndjson" if page.stream == "ndjson" else "text/csv"
+        blocks = data.iter_rows(positions, page.offset, page.limit, page.fields)
+        return StreamingResponse(stream_rows(blocks, page.stream), media_type=media_type,
+                                 headers={"X-Total-Count": str(len(positions))})
+
+    # serialized here, in the executor thread, instead of by FastAPI on the event loop
+    content = encode_rows(data, positions, page.offset, page.limit, page.fields, page.format, t)
+    return Response(content, media_type=ROW_FORMATS[page.format], headers={"X-Total-Count": str(len(positions))})
+
+
+def search_column(column, value, page, queued_at):
+    t = metrics.lap("search", "queue", queued_at)
+    data = pricing_table()
+    t = metrics.lap("search", "load", t)
+    positions = data.positions(column, value)
+    t = metrics.lap("search", "filter", t)
+    return search_response(data, positions, page, t)
 
-    return sample.to_dict()
 
 @app.get("/Search_model/{model_key}", tags=["Data Exploration Endpoints"])
-async def search_model(model_key: object):
+async def search_model(model_key: object, page: Page = Depends()):
     """
     Search data per model name : \n
     'Citroën', 'Peugeot', 'PGO', 'Renault', 'Audi', 'BMW', 'Ford',
@@ -102,21 +330,13 @@ async def search_model(model_key: object):
     'Alfa Romeo', 'Ferrari', 'Fiat', 'Lamborghini', 'Maserati',
     'Honda', 'Mazda', 'Mitsubishi', 'Nissan', 'SEAT', 'Subaru',
     'Toyota', 'Suzuki', 'Yamaha']
-    try:
-        if model_key not in model_list:
-            raise ValueError("You entered an input outside the allowed list of keys")
-        data = pd.read_csv("https://jedha-getaround-project.s3.amazonaws.com/pricing_data_cleaned.csv")
-
-        model = data[data["model_key"]==model_key]
-
-        return model.to_dict()
-    
-    except Exception as e:
-        return {"error": str(e)}
+    if model_key not in model_list:
+        return {"error": "You entered an input outside the allowed list of keys"}
+    return await run_blocking(search_column, "model_key", model_key, page, metrics.clock(), timeout=SEARCH_TIMEOUT)
 
 
 @app.get("/Search_type/{car_type}", tags=["Data Exploration Endpoints"])
-async def search_type(car_type: object):
+async def search_type(car_type: object, page: Page = Depends()):
     """
     Search data for the selected type of car : \n
     'convertible', 'coupe', 'estate', 'hatchback', 'sedan',
@@ -126,20 +346,12 @@ async def search_type(car_type: object):
     type_list = ['convertible', 'coupe', 'estate', 'hatchback', 'sedan',
     'subcompact', 'suv', 'van']
 
-    try:
-        if car_type not in type_list:
-            raise ValueError("You entered an input outside the allowed list of car types")
-        data = pd.read_csv("https://jedha-getaround-project.s3.amazonaws.com/pricing_data_cleaned.csv")
-
-        cartype = data[data["car_type"]==car_type]
-
-        return cartype.to_dict()
-    
-    except Exception as e:
-        return {"error": str(e)}
+    if car_type not in type_list:
+        return {"error": "You entered an input outside the allowed list of car types"}
+    return await run_blocking(search_column, "car_type", car_type, page, metrics.clock(), timeout=SEARCH_TIMEOUT)
 
 @app.get("/Search_fuel/{fuel}", tags=["Data Exploration Endpoints"])
-async def search_fuel(fuel: object):
+async def search_fuel(fuel: object, page: Page = Depends()):
     """
     Search data for the selected type of fuel : \n
     'diesel', 'petrol', 'hybrid_petrol', 'electro'
@@ -147,17 +359,62 @@ async def search_fuel(fuel: object):
     """
 
     fuel_list = ['diesel', 'petrol', 'hybrid_petrol', 'electro']
-    try:
-        if fuel not in fuel_list:
-            raise ValueError("You entered an input outside the allowed list of car types")
-        data = pd.read_csv("https://jedha-getaround-project.s3.amazonaws.com/pricing_data_cleaned.csv")
-
-        fuel = data[data["fuel"]==fuel]
-
-        return fuel.to_dict()
-    
-    except Exception as e:
-        return {"error": str(e)}
+    if fuel not in fuel_list:
+        return {"error": "You entered an input outside the allowed list of car types"}
+    return await run_blocking(search_column, "fuel", fuel, page, metrics.clock(), timeout=SEARCH_TIMEOUT)
+
+
+@app.get("/search", tags=["Data Exploration Endpoints"])
+async def search(model_key: Optional[str] = None,
+                 car_type: Optional[str] = None,
+                 fuel: Optional[str] = None,
+                 paint_color: Optional[str] = None,
+                 min_mileage: Optional[float] = None,
+                 max_mileage: Optional[float] = None,
+                 min_engine_power: Optional[float] = None,
+                 max_engine_power: Optional[float] = None,
+                 min_price: Optional[float] = None,
+                 max_price: Optional[float] = None,
+                 aggregates: Optional[str] = Query(None, description="Comma separated list among count, mean, median, min, max"),
+                 group_by: Optional[Literal["model_key", "car_type", "fuel", "paint_color"]] = None,
+                 page: Page = Depends()):
+    """
+    Search data with any combination of filters : \n
+    - model_key, car_type, fuel, paint_color : keep the cars with this value \n
+    - min_mileage / max_mileage, min_engine_power / max_engine_power, min_price / max_price : keep the cars
+    within these bounds (included), the price being the rental price per day \n
+    For example `/search?fuel=diesel&car_type=suv&max_mileage=50000` \n
+    With `aggregates=count,mean,median` the endpoint returns these statistics of the rental price per day of the
+    matching cars instead of the cars themselves, for each value of `group_by` if it is given.
+   
+    """
+    equals = {column: value for column, value in
+              [("model_key", model_key), ("car_type", car_type), ("fuel", fuel), ("paint_color", paint_color)]
+              if value is not None}
+    ranges = {column: (low, high) for column, low, high in
+              [("mileage", min_mileage, max_mileage),
+               ("engine_power", min_engine_power, max_engine_power),
+               ("rental_price_per_day", min_price, max_price)]
+              if low is not None or high is not None}
+    return await run_blocking(search_rows, equals, ranges, aggregates, group_by, page, metrics.clock(),
+                              timeout=SEARCH_TIMEOUT)
+
+
+def search_rows(equals, ranges, aggregates, group_by, page, queued_at):
+    t = metrics.lap("search", "queue", queued_at)
+    # "count, mean" as well as "count,mean"
+    names = [name.strip() for name in (aggregates or "").split(",") if name.strip()]
+    if group_by is not None and not names:
+        raise ValueError("group_by can only be used with aggregates, e.g. aggregates=count,mean")
+    data = pricing_table()
+    t = metrics.lap("search", "load", t)
+    positions = data.filter(equals, ranges)
+    t = metrics.lap("search", "filter", t)
+    if names:
+        result = data.aggregate(positions, names, group_by)
+        metrics.lap("search", "aggregate", t)
+        return result
+    return search_response(data, positions, page, t)
 
 
 # Defining required input for the prediction endpoint
@@ -177,9 +434,105 @@ class Features(BaseModel):
     winter_tires: bool
 
 
+NON_FINITE_ERROR = "The model returned a price that is not a finite number"
+
+
+def score_rows(rows, operation=None):
+    """
+    Score a list of feature dicts with a single transform and predict call.
+    Returns the predictions and the error messages, both in the order of the rows
+    (None as prediction for a row that could not be scored), and the version of the model that scored them.
+    With an operation, the transform and model calls are recorded as its stages.
+
+    """
+    model, preprocessor, pricer, version = registry.get()
+
+    def predict_rows(rows):
+        t = metrics.clock()
+        if pricer is not None:
+            X = pricer.transform(rows)
+        else:
+            import pandas as pd
+            X = preprocessor.transform(pd.DataFrame(rows))
+        if operation is not None:
+            t = metrics.lap(operation, "transform", t)
+        predictions = pricer.predict_matrix(X) if pricer is not None else model.predict(X)
+        if operation is not None:
+            metrics.lap(operation, "model", t)
+        return predictions
+
+    predictions, errors = score_halves(predict_rows, rows)
+    return predictions, errors, version
+
+
+def score_queued(rows):
+    """
+    score_rows for the micro-batcher: each prediction comes with the version of the model, for the cache.
+    The transform and model stages of /predict are recorded once per micro-batch.
+    """
+    predictions, errors, version = score_rows(rows, "predict")
+    return [None if pred is None else (pred, version) for pred in predictions], errors
+
+
+def score_halves(predict_rows, rows):
+    """
+    Score the rows at once, and if some row can not be transformed (e.g. unknown category), score each half
+    separately: a few bad rows cost a few extra calls on ever smaller slices instead of one call per row.
+
+    """
+    try:
+        predictions = [float(pred) for pred in predict_rows(rows)]
+    except Exception as e:
+        if len(rows) == 1:
+            return [None], [str(e)]
+        middle = len(rows) // 2
+        left_predictions, left_errors = score_halves(predict_rows, rows[:middle])
+        right_predictions, right_errors = score_halves(predict_rows, rows[middle:])
+        return left_predictions + right_predictions, left_errors + right_errors
+    # a NaN or infinite price can not be serialized nor cached: reported as the error of its row
+    errors = [None if math.isfinite(pred) else NON_FINITE_ERROR for pred in predictions]
+    return [pred if error is None else None for pred, error in zip(predictions, errors)], errors
+
+
+def price_car(features, queued_at):
+    """Rounded prediction of one feature dict, and the version of the model that computed it"""
+    t = metrics.lap("predict", "queue", queued_at)
+    # Get the model & preprocessor loaded at startup (checking for new files may load them again)
+    model, preprocessor, pricer, version = registry.get()
+    if pricer is not None:
+        # Plain NumPy scoring, no DataFrame nor ColumnTransformer for a single car
+        X = pricer.transform([features])
+        t = metrics.lap("predict", "transform", t)
+        prediction = round(float(pricer.predict_matrix(X)[0]), 2)
+    else:
+        # Assuming the preprocessor is a StandardScaler or a similar transformer
+        import pandas as pd
+        X = preprocessor.transform(pd.DataFrame(features, index=[0]))
+        t = metrics.lap("predict", "transform", t)
+        prediction = round(float(model.predict(X)[0]), 2)
+    metrics.lap("predict", "model", t)
+    if not math.isfinite(prediction):
+        raise ValueError(NON_FINITE_ERROR)
+    return prediction, version
+
+
+def score_chunks(rows):
+    """score_rows for any number of rows, BATCH_CHUNK_SIZE rows at a time"""
+    predictions, errors = [], []
+    for start in range(0, len(rows), BATCH_CHUNK_SIZE):
+        chunk_predictions, chunk_errors, _ = score_rows(rows[start:start + BATCH_CHUNK_SIZE])
+        predictions += chunk_predictions
+        errors += chunk_errors
+    return predictions, errors
+
+
+batcher = (MicroBatcher(score_queued, MICRO_BATCH_WAIT_MS, MICRO_BATCH_MAX_SIZE, executor=executor.pool,
+                        max_pending=MICRO_BATCH_MAX_PENDING)
+           if MICRO_BATCHING else None)
+
 
 @app.post("/predict", tags=["AI Solutions Endpoints"])
-async def predict(Features: Features):
+async def predict(Features: Features, request: Request):
     """
     Get the estimated rental price of for your car after providing the relevant information.\n
     Here is an example input: \n
@@ -203,26 +556,271 @@ async def predict(Features: Features):
 
     """
 
-    data = pd.DataFrame(dict(Features), index=[0])
-    
-    # Load the model & preprocessor
+    # time since the request was received: reading the body and validating the features
+    t = metrics.lap("predict", "validate", getattr(request.state, "metrics_start", 0.0))
+
+    if not registry.ready:
+        return {"error": "The model is not loaded yet"}  # Return error message if the model is not available
+
+    # Same car as a recent request for the current model: answer from the cache
+    features = dict(Features)
+    key = cache_key(features)
+    if prediction_cache.enabled:
+        if registry.check_due():
+            # a cache hit does not call registry.get(): check for new files here, so that a new model
+            # bumps the version and the cached prices of the old one are not served until they expire
+            try:
+                await executor.run(registry.reload_if_changed, timeout=RELOAD_TIMEOUT)
+            except BUSY:
+                pass  # checked again on the next interval
+        cached = prediction_cache.get(key, registry.version)
+        t = metrics.lap("predict", "cache", t)
+        if cached is not None:
+            return {"prediction": cached}
+
+    if batcher is not None:
+        # Scored together with the other requests received in the same few milliseconds
+        try:
+            pred, version = await batcher.submit(features, timeout=PREDICT_TIMEOUT)
+        except BUSY:
+            raise
+        except Exception as e:
+            return {"error": str(e)}
+        prediction = round(pred, 2)
+        metrics.lap("predict", "batcher", t)
+    else:
+        try:
+            prediction, version = await executor.run(price_car, features, metrics.clock(), timeout=PREDICT_TIMEOUT)
+        except BUSY:
+            raise
+        except Exception as e:
+            return {"error": str(e)}  # Return error message if transformation or prediction fails
+
+    if prediction_cache.enabled:
+        # tagged with the version that computed it, not the current one: a model loaded meanwhile is newer
+        prediction_cache.put(key, prediction, version)
+    t = metrics.clock()
+    response = JSONResponse({"prediction": prediction})
+    metrics.lap("predict", "serialize", t)
+    return response
+
+
+@app.post("/predict/batch", tags=["AI Solutions Endpoints"])
+async def predict_batch(cars: List[Any]):
+    """
+    Get the estimated rental prices of a list of cars in one request.\n
+    Every item of the list has the same fields as the input of **/predict**.
+    The cars are scored together, in chunks of rows, which is much faster than calling **/predict** once per car.\n
+    The returned output keeps the order of the input:
+    {predictions: [187.08, null, ...], errors: [{index: 1, error: "..."}]}\n
+    A car that can not be scored, or an item that is not a car object, gets a null prediction and its error is reported
+    with its position in the list.
+
+    """
+    if len(cars) > MAX_BATCH_SIZE:
+        return JSONResponse(status_code=413,
+                            content={"error": f"A batch can contain at most {MAX_BATCH_SIZE} cars, got {len(cars)}"})
+
     try:
-        model = joblib.load('svr_model.pkl')
-        preprocessor = joblib.load('preprocessor.pkl')
+        return await executor.run(price_batch, cars, timeout=BATCH_TIMEOUT)
+    except BUSY:
+        raise
     except Exception as e:
-        return {"error": str(e)}  # Return error message if loading fails
+        return {"error": str(e)}
+
+
+def price_batch(cars):
+    predictions = [None] * len(cars)
+    errors = []
+
+    # Validate every car on its own so one bad row does not reject the whole batch
+    rows, positions = [], []
+    for i, car in enumerate(cars):
+        try:
+            rows.append(dict(Features.model_validate(car)))
+            positions.append(i)
+        except ValidationError as e:
+            errors.append({"index": i, "error": e.errors(include_url=False)})
+
+    preds, row_errors = score_chunks(rows)
+    for i, pred, error in zip(positions, preds, row_errors):
+        if pred is None:
+            errors.append({"index": i, "error": error})
+        else:
+            predictions[i] = round(pred, 2)
+
+    errors.sort(key=lambda error: error["index"])
+    return {"predictions": predictions, "errors": errors}
 
-    # Assuming the preprocessor is a StandardScaler or a similar transformer
+
+# A minimum delay policy to evaluate
+class Policy(BaseModel):
+    threshold: float = Field(ge=0)
+    scope: Literal["all", "connect", "mobile"] = "all"
+    flexibility: float = Field(0, ge=0)
+
+
+@app.post("/policy/evaluate", tags=["Delay Policy Endpoints"])
+async def evaluate_policies(policies: List[Policy]):
+    """
+    Evaluate minimum delays between two rentals on the rentals of the delay analysis.\n
+    Every item is a policy: `threshold` (minutes required between the anticipated checkout and the next checkin),
+    `scope` (the cars it applies to: all, connect or mobile) and `flexibility` (minutes customers accept to wait
+    after the pick-up time they asked for). Example input: \n
+    [{"threshold": 120, "scope": "connect", "flexibility": 60}, {"threshold": 180, "scope": "all"}] \n
+    For each policy, in the same order, the output gives:
+    - **solved**: cases of a car late for the next checkin the threshold would have avoided
+    - **blocked**: consecutive rentals that would not have been allowed, beyond the customer's flexibility
+    - **successful**: consecutive rentals without a car late for the checkin we would have had \n
+    These are the curves of the dashboard, results are memoized until the delay data changes.
+
+    """
+    if len(policies) > MAX_BATCH_SIZE:
+        return JSONResponse(status_code=413,
+                            content={"error": f"A batch can contain at most {MAX_BATCH_SIZE} policies, got {len(policies)}"})
     try:
-        X = preprocessor.transform(data)
+        results = await executor.run(evaluate_rows, [(p.threshold, p.scope, p.flexibility) for p in policies],
+                                     timeout=POLICY_TIMEOUT)
+    except BUSY:
+        raise
     except Exception as e:
-        return {"error": str(e)}  # Return error message if transformation fails
+        return {"error": str(e)}
+    return {"results": [{**dict(p), **result} for p, result in zip(policies, results)]}
+
 
+@app.get("/ready", tags=["Operations Endpoints"])
+async def ready():
+    """
+    Returns 200 once the model and preprocessor are loaded, 503 before that.
+
+    """
+    if not registry.ready:
+        return JSONResponse(status_code=503, content={"ready": False})
+    return registry.status()
+
+
+@app.get("/metrics/batcher", tags=["Operations Endpoints"])
+async def batcher_metrics():
+    """
+    Distribution of the micro-batch sizes and of the time requests waited in the queue (in milliseconds).
+    Micro-batching is enabled with the environment variable MICRO_BATCHING=1, the wait window and the 
+    batch size are set with MICRO_BATCH_WAIT_MS and MICRO_BATCH_MAX_SIZE, and at most MICRO_BATCH_MAX_PENDING
+    cars wait in the queue before requests are rejected with a 429.
+
+    """
+    if batcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **batcher.metrics()}
+
+
+@app.get("/metrics/cache", tags=["Operations Endpoints"])
+async def cache_metrics():
+    """
+    Counters of the cache of **/predict** results. Its size is set with the environment variables
+    PREDICTION_CACHE_SIZE (number of cars, 0 disables the cache) and PREDICTION_CACHE_MAX_BYTES,
+    and PREDICTION_CACHE_TTL sets for how many seconds a prediction is reused.
+    The cache is emptied when a new version of the model is loaded.
+
+    """
+    return prediction_cache.stats()
+
+
+@app.get("/metrics/policy", tags=["Operations Endpoints"])
+async def policy_metrics():
+    """
+    Version of the delay data used by **/policy/evaluate** and counters of its memoized results.
+    POLICY_CACHE_SIZE sets how many policies are kept (0 disables the memoization) and DELAY_CHECK_INTERVAL
+    how often (in seconds) the data is checked for a new version.
+
+    """
+    if "delay_policies" not in sys.modules:
+        return {"loaded": False}  # no policy evaluated by this worker yet
+    return get_delay_policies().stats()
+
+
+@app.get("/metrics/executor", tags=["Operations Endpoints"])
+async def executor_metrics():
+    """
+    State of the thread pool running the blocking work of the endpoints: EXECUTOR_THREADS threads, and at most
+    EXECUTOR_MAX_PENDING tasks running or queued before requests are rejected with a 429. The timeouts of the
+    endpoints (in seconds) are set with PREDICT_TIMEOUT, BATCH_TIMEOUT, SEARCH_TIMEOUT, POLICY_TIMEOUT and RELOAD_TIMEOUT.
+
+    """
+    return executor.stats()
+
+
+@app.get("/metrics", tags=["Operations Endpoints"])
+async def prometheus_metrics():
+    """
+    All the metrics in the Prometheus text format, to be scraped by a Prometheus server.
+    The latencies of the endpoints and of the stages of **/predict** (validate, cache, queue, transform, model,
+    serialize) and of the searches (queue, load, filter, rows, serialize) are only recorded with METRICS=1;
+    without it, timing is skipped entirely and only the state of the model, caches and executor is reported.
+    With MICRO_BATCHING=1 the batch sizes and queue waits of the micro-batcher are exported as histograms too.
+
+    """
+    cache, pool = prediction_cache.stats(), executor.stats()
+    gauges = {
+        "model_loaded": ("1 once the model is loaded", int(registry.ready)),
+        "model_version": ("Number of times the model was loaded", registry.version),
+        "model_load_seconds": ("Time the last model load took", registry.load_seconds),
+        "prediction_cache_entries": ("Predictions in the cache", cache["entries"]),
+        "prediction_cache_bytes": ("Estimated size of the cached predictions", cache["bytes"]),
+        "executor_pending": ("Tasks running or queued in the executor", pool["pending"]),
+    }
+    counters = {
+        "prediction_cache_hits": ("Predictions answered from the cache", cache["hits"]),
+        "prediction_cache_misses": ("Predictions not found in the cache", cache["misses"]),
+        "prediction_cache_evictions": ("Predictions evicted from the cache", cache["evictions"]),
+        "executor_rejected": ("Requests rejected with a 429", pool["rejected"]),
+        "executor_timed_out": ("Requests answered with a 504", pool["timed_out"]),
+    }
+    histograms = {}
+    if batcher is not None:
+        queue = batcher.metrics()
+        gauges["batcher_queued"] = ("Cars waiting to be batched", queue["queued"])
+        counters["batcher_rejected"] = ("Predictions rejected with a 429 because the batch queue was full", queue["rejected"])
+        counters["batcher_timed_out"] = ("Predictions answered with a 504 while queued or scored", queue["timed_out"])
+        histograms["batcher_batch_size"] = ("Cars scored per model call of the micro-batcher", batcher.batch_sizes)
+        histograms["batcher_queue_wait_milliseconds"] = ("Time a car waited in the batch queue", batcher.queue_wait_ms)
+    if "delay_policies" in sys.modules:
+        policies = get_delay_policies().stats()
+        counters["policy_cache_hits"] = ("Policy evaluations answered from memory", policies["hits"])
+        counters["policy_cache_misses"] = ("Policy evaluations computed", policies["misses"])
+    return PlainTextResponse(render_prometheus(metrics, gauges, counters, histograms), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/debug/profile", tags=["Operations Endpoints"])
+async def profile(seconds: float = Query(5, gt=0, le=60), interval_ms: float = Query(10, ge=1, le=1000)):
+    """
+    Sample the stacks of all the threads of this worker every interval_ms milliseconds for a few seconds,
+    and return them in the folded format read by flamegraph.pl and speedscope:\n
+    curl "http://localhost:4000/debug/profile?seconds=10" > stacks.txt && flamegraph.pl stacks.txt > profile.svg\n
+    Only available when the API is started with PROFILING=1.
+
+    """
+    if not PROFILING:
+        return JSONResponse(status_code=404, content={"error": "Profiling is disabled, start the API with PROFILING=1"})
+    # sampled from a thread of its own, so that the event loop and the executor keep serving the requests
+    stacks = await asyncio.get_running_loop().run_in_executor(None, sample_stacks, seconds, interval_ms / 1000)
+    return PlainTextResponse(stacks)
+
+
+@app.post("/model/reload", tags=["Operations Endpoints"])
+async def reload_model():
+    """
+    Load the model and preprocessor files again and swap them in for the following requests.\n
+    Workers serving MODEL_DIR or COMPILED_MODEL_DIR also pick up a new version on their own every few seconds,
+    this endpoint only forces it on the worker that receives the call. Plain pickle paths are only reloaded by it.
+
+    """
     try:
-        preds = model.predict(X)
-        return {"prediction": round(preds[0],2)}
+        await executor.run(registry.load, timeout=RELOAD_TIMEOUT)
+    except BUSY:
+        raise
     except Exception as e:
-        return {"error": str(e)}  # Return error message if prediction fails
+        return {"error": str(e)}
+    return registry.status()
 
 
 if __name__ == "__main__":
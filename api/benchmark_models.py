@@ -0,0 +1,95 @@
+"""
+Compare the latency, throughput and error of SVR_with_InverseScaler and KernelApprox_with_InverseScaler.
+
+Both models are trained on the same 80% of the pricing dataset (transformed by the preprocessor of the API)
+and evaluated on the remaining 20%.
+
+    python benchmark_models.py ../data/get_around_pricing_project.csv
+    python benchmark_models.py ../data/get_around_pricing_project.csv --save   # also writes kernel_approx_model.pkl
+"""
+import argparse
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import StandardScaler
+from sklearn.svm import SVR
+
+from model_definition import SVR_with_InverseScaler, KernelApprox_with_InverseScaler
+from model_registry import MODEL_VARIANTS, ModelRegistry
+
+TARGET = "rental_price_per_day"
+
+
+def models():
+    return {
+        "svr": SVR_with_InverseScaler(StandardScaler(), SVR(kernel='rbf', C=1, degree=3, gamma='scale', epsilon=0.1)),
+        "nystroem": KernelApprox_with_InverseScaler(StandardScaler(), method='nystroem', n_components=500),
+        "rff": KernelApprox_with_InverseScaler(StandardScaler(), method='rff', n_components=2000),
+    }
+
+
+def measure(model, X_train, y_train, X_test, y_test, repeat):
+    start = time.perf_counter()
+    model.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+
+    latencies = []
+    for i in range(repeat):
+        row = X_test[i % X_test.shape[0]]
+        start = time.perf_counter()
+        model.predict(row)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    preds = model.predict(X_test)
+    batch_seconds = time.perf_counter() - start
+
+    return {
+        "fit_s": fit_seconds,
+        "p50_ms": np.percentile(latencies, 50) * 1000,
+        "p99_ms": np.percentile(latencies, 99) * 1000,
+        "rows_per_s": X_test.shape[0] / batch_seconds,
+        "rmse": np.sqrt(mean_squared_error(y_test, preds)),
+        "r2": r2_score(y_test, preds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv", help="pricing dataset")
+    parser.add_argument("--repeat", type=int, default=500, help="number of single car predictions to time")
+    parser.add_argument("--save", action="store_true",
+                        help=f"fit the Nystroem model on the whole dataset and save it as {MODEL_VARIANTS['kernel_approx']}")
+    args = parser.parse_args()
+
+    # the pickled preprocessor, also when the API serves a compiled model (COMPILED_MODEL_DIR)
+    registry = ModelRegistry(compiled_dir=None)
+    registry.load()
+    _, preprocessor, _, _ = registry.get()
+    data = pd.read_csv(args.csv, index_col=0)
+    # keep the cars the preprocessor can encode
+    for _, transformer, columns in preprocessor.transformers_:
+        encoder = transformer.steps[-1][1]
+        for column, categories in zip(columns, getattr(encoder, "categories_", [])):
+            data = data[data[column].isin(categories)]
+
+    X = preprocessor.transform(data.drop(columns=[TARGET])).tocsr()
+    y = data[[TARGET]].to_numpy(dtype=float)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=0)
+
+    results = {name: measure(model, X_train, y_train, X_test, y_test.ravel(), args.repeat)
+               for name, model in models().items()}
+    print(pd.DataFrame(results).T.round(3).to_string())
+
+    if args.save:
+        model = models()["nystroem"].fit(X, y)
+        joblib.dump(model, MODEL_VARIANTS["kernel_approx"])
+        print(f"saved {MODEL_VARIANTS['kernel_approx']}, serve it with MODEL_VARIANT=kernel_approx")
+
+
+if __name__ == "__main__":
+    main()
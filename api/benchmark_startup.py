@@ -0,0 +1,141 @@
+"""
+Cold start of the API: import time of app.py, time until a server answers, and memory of its processes.
+
+    python benchmark_startup.py --workers 4
+    python benchmark_startup.py --workers 4 --output results/startup.json
+
+For each mode it starts a local server, measures the time until /ready answers 200 and until the first /predict
+and /search are answered, then reads the resident (RSS) and proportional (PSS, shared pages split between the
+processes sharing them) memory of the master and each worker from /proc. PSS is the memory a worker actually
+costs: with gunicorn preloading the app, the pages of the libraries and of the model are shared with the master.
+The modes are gunicorn with preloading (gunicorn.conf.py), gunicorn without it (GUNICORN_PRELOAD=0) and uvicorn.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+from load_test import git_commit, process_tree, rss_mb
+
+CAR = {"model_key": "Porsche", "mileage": 30000, "engine_power": 220, "fuel": "diesel", "paint_color": "black",
+       "car_type": "sedan", "private_parking_available": True, "has_gps": False, "has_air_conditioning": True,
+       "automatic_car": False, "has_getaround_connect": True, "has_speed_regulator": True, "winter_tires": True}
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import app
+print(time.perf_counter() - start, "pandas" in sys.modules, "sklearn" in sys.modules)
+"""
+
+
+def import_time(repeat):
+    """Median time to import app.py in a fresh interpreter, and whether pandas and scikit-learn were imported."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-W", "ignore", "-c", IMPORT_SCRIPT], capture_output=True,
+                                text=True, check=True).stdout.split()
+        runs.append((float(output[0]), output[1] == "True", output[2] == "True"))
+    return {"import_seconds": statistics.median(run[0] for run in runs), "pandas": runs[-1][1], "sklearn": runs[-1][2]}
+
+
+def pss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def request(url, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=60) as response:
+        return response.status
+
+
+def wait_until(url, server, deadline):
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("The server exited")
+        try:
+            if request(url) == 200:
+                return
+        except (urllib.error.URLError, ConnectionError):
+            pass
+        time.sleep(0.02)
+    raise RuntimeError("The server did not start")
+
+
+def server_command(mode, args):
+    if mode == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.port), "--workers", str(args.workers),
+                "--log-level", "warning"]
+    return [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{args.port}",
+            "--workers", str(args.workers), "--log-level", "warning"]
+
+
+def measure(mode, args):
+    env = dict(os.environ, GUNICORN_PRELOAD="0" if mode == "gunicorn-no-preload" else "1")
+    base_url = f"http://127.0.0.1:{args.port}"
+    start = time.monotonic()
+    server = subprocess.Popen(server_command(mode, args), env=env)
+    try:
+        wait_until(f"{base_url}/ready", server, start + 120)
+        ready = time.monotonic() - start
+        request(f"{base_url}/predict", CAR)
+        first_predict = time.monotonic() - start
+        request(f"{base_url}/search?fuel=diesel&limit=10")
+        first_search = time.monotonic() - start
+        time.sleep(args.settle)  # let the other workers finish starting
+        pids = process_tree(server.pid)
+        memory = {str(pid): {"rss_mb": rss_mb(pid), "pss_mb": pss_mb(pid)} for pid in pids}
+    finally:
+        server.terminate()
+        server.wait()
+    total_pss = sum(m["pss_mb"] or 0 for m in memory.values())
+    result = {"mode": mode, "workers": args.workers, "ready_seconds": ready, "first_predict_seconds": first_predict,
+              "first_search_seconds": first_search, "total_pss_mb": total_pss, "memory": memory}
+    print(f"{mode:>20}  ready {ready:6.2f} s  first predict {first_predict:6.2f} s  first search {first_search:6.2f} s  "
+          f"total PSS {total_pss:7.1f} MB  ({len(pids)} processes)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="../data/get_around_pricing_project.csv", help="pricing dataset (CSV)")
+    parser.add_argument("--modes", nargs="+", choices=["gunicorn", "gunicorn-no-preload", "uvicorn"],
+                        default=["gunicorn", "gunicorn-no-preload", "uvicorn"])
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=3, help="runs of the import time measure")
+    parser.add_argument("--settle", type=float, default=3, help="seconds waited before reading the memory")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--output", help="JSON file to save the results to")
+    args = parser.parse_args()
+
+    os.environ.setdefault("PRICING_DATA_PATH", args.data)
+    imports = import_time(args.repeat)
+    print(f"import app: {imports['import_seconds']:.2f} s  (pandas imported: {imports['pandas']}, "
+          f"scikit-learn imported: {imports['sklearn']})")
+    results = [measure(mode, args) for mode in args.modes]
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        report = {"commit": git_commit(), "created_at": datetime.now(timezone.utc).isoformat(),
+                  "cpu_count": os.cpu_count(), **imports, "results": results}
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
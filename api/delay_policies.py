@@ -0,0 +1,106 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# shared with the dashboard, installed from the delay-analysis folder of the repository
+from delay_analysis.delay_data import DATA_URL, add_features, load_sheets, source_version
+from delay_analysis.simulation import DelaySimulation
+
+# how often (in seconds) the delay workbook is checked for a new version
+DELAY_CHECK_INTERVAL = float(os.environ.get("DELAY_CHECK_INTERVAL", "300"))
+# number of evaluated policies kept in memory, 0 disables the memoization
+POLICY_CACHE_SIZE = int(os.environ.get("POLICY_CACHE_SIZE", "100000"))
+
+
+class DelayPolicies:
+    """
+    Evaluates minimum delay policies on the delay workbook, with the same DelaySimulation as the dashboard.
+
+    The simulation is built once per version of the workbook. Evaluated (threshold, scope, flexibility)
+    policies are memoized in an LRU, emptied when a new version of the workbook is loaded.
+    """
+
+    def __init__(self, source=DATA_URL, check_interval=DELAY_CHECK_INTERVAL, cache_size=POLICY_CACHE_SIZE):
+        self.source = source
+        self.check_interval = check_interval
+        self.cache_size = cache_size
+        self._simulation = None
+        self._version = None
+        self._last_check = 0.0
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # held while reading or updating the memoized results
+        self._load_lock = threading.Lock()  # held while loading
+
+    def load(self, version=None, only_if_changed=False):
+        """
+        Build the simulation of the workbook (of its current version if version is None). With only_if_changed,
+        nothing is loaded if this version is already loaded (any version if None): checked under the lock,
+        so the requests noticing a new workbook at once, or arriving before the first load, load it only once.
+        """
+        with self._load_lock:
+            if only_if_changed and self._simulation is not None and version in (None, self._version):
+                return self._simulation
+            version = version if version is not None else source_version(self.source)
+            rentals, _ = load_sheets(self.source, version)
+            simulation = DelaySimulation.from_frame(add_features(rentals))
+            with self._lock:
+                self._simulation, self._version = simulation, version
+                self._results.clear()
+                self._last_check = time.monotonic()
+        return simulation
+
+    def get(self):
+        """Return the current DelaySimulation, loading it again if the workbook changed."""
+        simulation = self._simulation
+        if simulation is None:
+            return self.load(only_if_changed=True)
+        now = time.monotonic()
+        if now - self._last_check > self.check_interval:
+            self._last_check = now
+            version = source_version(self.source)
+            # an unreachable source keeps the current version
+            if version is not None and version != self._version:
+                try:
+                    return self.load(version, only_if_changed=True)
+                except Exception:
+                    return simulation
+        return simulation
+
+    def evaluate(self, policies):
+        """Outcomes of a list of (threshold, scope, flexibility) tuples, the new ones computed in one batch."""
+        simulation = self.get()
+        keys = [(float(threshold), scope, float(flexibility)) for threshold, scope, flexibility in policies]
+        results = [None] * len(keys)
+        missing = []
+        with self._lock:
+            for i, key in enumerate(keys):
+                result = self._results.get(key)
+                if result is None:
+                    missing.append(i)
+                else:
+                    self._results.move_to_end(key)
+                    results[i] = result
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+
+        computed = simulation.evaluate([keys[i] for i in missing])
+        with self._lock:
+            # results of a workbook replaced in the meantime are returned but not kept
+            keep = self.cache_size > 0 and self._simulation is simulation
+            for i, result in zip(missing, computed):
+                results[i] = result
+                if keep:
+                    self._results[keys[i]] = result
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        return results
+
+    def stats(self):
+        return {"version": self._version, "cached_policies": len(self._results), "max_policies": self.cache_size,
+                "hits": self.hits, "misses": self.misses}
+
+
+delay_policies = DelayPolicies()
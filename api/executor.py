@@ -0,0 +1,65 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# threads running the blocking work of the endpoints (pandas, scikit-learn, file and network reads)
+EXECUTOR_THREADS = int(os.environ.get("EXECUTOR_THREADS", "4"))
+# tasks running or waiting for a thread before new requests get a 429
+EXECUTOR_MAX_PENDING = int(os.environ.get("EXECUTOR_MAX_PENDING", "32"))
+
+
+class Overloaded(Exception):
+    pass
+
+
+class BoundedExecutor:
+    """
+    Thread pool for the blocking sections of the async endpoints, so that a slow search or model load does not
+    stall the event loop and every other request of the worker.
+
+    At most `max_pending` tasks are accepted at once (running or queued): beyond that run() raises Overloaded
+    right away instead of letting the queue grow. A task is counted until its thread is done with it, even when
+    the request gave up on it after its timeout.
+    Threads rather than processes: the model and the datasets are shared in memory, and NumPy, pandas and
+    scikit-learn release the GIL in their heavy loops.
+    """
+
+    def __init__(self, max_workers=EXECUTOR_THREADS, max_pending=EXECUTOR_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="blocking")
+        self.pending = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._lock = threading.Lock()
+
+    def _release(self, _):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, func, *args, timeout=None):
+        """
+        Run func(*args) in the pool and return its result.
+        Raises Overloaded when too many tasks are pending and asyncio.TimeoutError after `timeout` seconds.
+        """
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded(f"Too many requests in progress ({self.pending}), retry later")
+            self.pending += 1
+        future = self.pool.submit(func, *args)
+        future.add_done_callback(self._release)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.TimeoutError:
+            # a task still queued is cancelled, a running one finishes in its thread
+            self.timed_out += 1
+            raise
+
+    def stats(self):
+        return {"threads": self.max_workers, "max_pending": self.max_pending, "pending": self.pending,
+                "rejected": self.rejected, "timed_out": self.timed_out}
+
+
+executor = BoundedExecutor()
@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+import uuid
+
+import numpy as np
+
+# version of the layout written by CompiledPricer.save
+EXPORT_FORMAT = 1
+EXPORT_ARRAYS = ("support_vectors", "sv_sq_norms", "dual_coef")
+
+
+class CompiledPricer:
+    """
+    Plain NumPy version of a fitted preprocessor + SVR_with_InverseScaler pair, for scoring feature dicts
+    without building a DataFrame or going through the ColumnTransformer.
+
+    Everything the sklearn objects would compute at each call is precomputed once:
+    - for numeric columns, the output position, mean and scale of the StandardScaler
+    - for categorical columns, a lookup table from category to output position (None for a dropped category)
+    - the dense support vectors with their squared norms, the dual coefficients, intercept and gamma of the RBF SVR
+    - the mean and scale of the target scaler
+
+    save() exports these parameters to a folder of .npy files (the arrays) and a pricer.json file (the rest),
+    published behind a symbolic link, and load() reads them back with the arrays memory-mapped: scikit-learn is not imported, nothing is unpickled,
+    and all the workers of a server read the support vectors from the same pages of the OS cache.
+    """
+
+    def __init__(self, n_features, numeric, categorical, support_vectors, dual_coef, intercept, gamma,
+                 y_mean, y_scale, sv_sq_norms=None):
+        self.n_features = n_features
+        self.numeric = numeric  # [(column, position, mean, scale)]
+        self.categorical = categorical  # [(column, {category: position or None})]
+        self.support_vectors = support_vectors
+        if sv_sq_norms is None:
+            sv_sq_norms = np.einsum("ij,ij->i", support_vectors, support_vectors)
+        self.sv_sq_norms = sv_sq_norms
+        self.dual_coef = dual_coef
+        self.intercept = intercept
+        self.gamma = gamma
+        self.y_mean = y_mean
+        self.y_scale = y_scale
+
+    @classmethod
+    def from_sklearn(cls, preprocessor, model):
+        """
+        Compile a fitted ColumnTransformer (StandardScaler and OneHotEncoder steps) and an SVR_with_InverseScaler
+        with an RBF kernel. Raises ValueError for any other structure.
+        """
+        from scipy import sparse
+        from sklearn.pipeline import Pipeline
+        from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+        svr = getattr(model, "svr", None)
+        if svr is None or svr.kernel != "rbf" or not isinstance(model.scaler, StandardScaler):
+            raise ValueError("Only SVR_with_InverseScaler with an RBF kernel can be compiled")
+        if preprocessor.remainder != "drop":
+            raise ValueError("Only a ColumnTransformer dropping the remaining columns can be compiled")
+
+        numeric, categorical = [], []
+        for name, transformer, columns in preprocessor.transformers_:
+            if transformer == "drop":
+                continue
+            steps = transformer.steps if isinstance(transformer, Pipeline) else [(name, transformer)]
+            if len(steps) != 1:
+                raise ValueError(f"Transformer {name} has more than one step")
+            step = steps[0][1]
+            start = preprocessor.output_indices_[name].start
+
+            if isinstance(step, StandardScaler):
+                means = step.mean_ if step.with_mean else np.zeros(len(columns))
+                scales = step.scale_ if step.with_std else np.ones(len(columns))
+                for i, column in enumerate(columns):
+                    numeric.append((column, start + i, float(means[i]), float(scales[i])))
+
+            elif isinstance(step, OneHotEncoder):
+                if step.handle_unknown != "error":
+                    raise ValueError(f"Transformer {name} does not raise on unknown categories")
+                drop_idx = step.drop_idx_ if step.drop_idx_ is not None else [None] * len(columns)
+                position = start
+                for column, categories, dropped in zip(columns, step.categories_, drop_idx):
+                    table = {}
+                    for j, category in enumerate(categories.tolist()):
+                        if j == dropped:
+                            table[category] = None
+                        else:
+                            table[category] = position
+                            position += 1
+                    categorical.append((column, table))
+            else:
+                raise ValueError(f"Transformer {name} of type {type(step).__name__} can not be compiled")
+
+        # fitted on the sparse output of the preprocessor, the SVR keeps sparse support vectors
+        support_vectors, dual_coef = svr.support_vectors_, svr.dual_coef_
+        if sparse.issparse(support_vectors):
+            support_vectors = support_vectors.toarray()
+        if sparse.issparse(dual_coef):
+            dual_coef = dual_coef.toarray()
+
+        return cls(
+            n_features=max(indices.stop for indices in preprocessor.output_indices_.values()),
+            numeric=numeric,
+            categorical=categorical,
+            support_vectors=np.ascontiguousarray(support_vectors, dtype=np.float64),
+            dual_coef=np.ascontiguousarray(dual_coef.ravel(), dtype=np.float64),
+            intercept=float(svr.intercept_[0]),
+            gamma=float(svr._gamma),
+            y_mean=float(model.scaler.mean_[0]) if model.scaler.with_mean else 0.0,
+            y_scale=float(model.scaler.scale_[0]) if model.scaler.with_std else 1.0,
+        )
+
+    def save(self, directory):
+        """
+        Export to `directory`, a symbolic link to a new folder of `<directory>.versions/` for each export: the files
+        are written to the new folder, then the link is replaced in one rename, like artifacts/latest in train.py.
+        A server resolving the link once (load()) reads all its files from the same export, and the previous
+        export is kept for the servers still loading it; the older ones are removed.
+        """
+        directory = directory.rstrip(os.sep)
+        versions = f"{directory}.versions"
+        version = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()) + "-" + uuid.uuid4().hex[:8]
+        version_dir = os.path.join(versions, version)
+        os.makedirs(version_dir)
+        for name in EXPORT_ARRAYS:
+            np.save(os.path.join(version_dir, f"{name}.npy"), getattr(self, name))
+        params = {
+            "format": EXPORT_FORMAT,
+            "n_features": self.n_features,
+            "numeric": self.numeric,
+            # categories can be booleans, which JSON objects do not accept as keys
+            "categorical": [(column, list(table.items())) for column, table in self.categorical],
+            "intercept": self.intercept,
+            "gamma": self.gamma,
+            "y_mean": self.y_mean,
+            "y_scale": self.y_scale,
+        }
+        with open(os.path.join(version_dir, "pricer.json"), "w") as f:
+            json.dump(params, f, indent=2)
+
+        previous = os.path.basename(os.path.realpath(directory)) if os.path.islink(directory) else None
+        if os.path.isdir(directory) and not os.path.islink(directory):
+            # a folder exported before the versions: moved among them so that the link can take its place
+            previous = "00000000T000000Z-folder"
+            os.rename(directory, os.path.join(versions, previous))
+        link = f"{directory}.link-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        os.symlink(os.path.join(os.path.basename(versions), version), link)
+        os.replace(link, directory)
+        for name in os.listdir(versions):
+            if name not in (version, previous):
+                shutil.rmtree(os.path.join(versions, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Pricer exported by save(), with its arrays memory-mapped (mmap_mode=None reads them in memory)."""
+        # the link is resolved once: a new export published meanwhile can not mix its files with this one
+        directory = os.path.realpath(directory)
+        with open(os.path.join(directory, "pricer.json")) as f:
+            params = json.load(f)
+        if params.pop("format") != EXPORT_FORMAT:
+            raise ValueError(f"{directory} was exported in another format, export the model again")
+        arrays = {name: np.asarray(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode))
+                  for name in EXPORT_ARRAYS}
+        params["numeric"] = [tuple(item) for item in params["numeric"]]
+        params["categorical"] = [(column, dict((category, position) for category, position in table))
+                                 for column, table in params["categorical"]]
+        return cls(**params, **arrays)
+
+    def transform(self, rows):
+        """Feature matrix of a list of feature dicts, same values as preprocessor.transform (but dense)."""
+        X = np.zeros((len(rows), self.n_features))
+        for i, row in enumerate(rows):
+            for column, position, mean, scale in self.numeric:
+                X[i, position] = (row[column] - mean) / scale
+            for column, table in self.categorical:
+                try:
+                    position = table[row[column]]
+                except KeyError:
+                    raise ValueError(f"Found unknown categories [{row[column]!r}] in column {column} during transform")
+                if position is not None:
+                    X[i, position] = 1.0
+        if not np.isfinite(X).all():
+            # rejected with the errors the SVR raises on the sklearn path
+            if np.isnan(X).any():
+                raise ValueError("Input X contains NaN.")
+            raise ValueError("Input X contains infinity or a value too large for dtype('float64').")
+        return X
+
+    def predict_matrix(self, X):
+        # squared distances to every support vector, expanded as |sv|^2 - 2 sv.x + |x|^2
+        sq_dist = self.sv_sq_norms[None, :] - 2.0 * (X @ self.support_vectors.T) + np.einsum("ij,ij->i", X, X)[:, None]
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        scaled = np.exp(-self.gamma * sq_dist) @ self.dual_coef + self.intercept
+        return scaled * self.y_scale + self.y_mean
+
+    def predict(self, rows):
+        """Predicted prices of a list of feature dicts."""
+        return self.predict_matrix(self.transform(rows))
+
+    def predict_one(self, row):
+        return float(self.predict([row])[0])
+
+
+def check_parity(csv_path, preprocessor, model, target="rental_price_per_day"):
+    """
+    Compare the compiled path with preprocessor.transform + model.predict on every row of a CSV file.
+    Rows with categories unknown to the preprocessor are skipped. Returns (rows compared, max absolute difference).
+    """
+    import pandas as pd
+
+    pricer = CompiledPricer.from_sklearn(preprocessor, model)
+    data = pd.read_csv(csv_path, index_col=0).drop(columns=[target], errors="ignore")
+    for column, table in pricer.categorical:
+        data = data[data[column].isin(list(table))]
+
+    expected = model.predict(preprocessor.transform(data))
+    actual = pricer.predict(data.to_dict(orient="records"))
+    return len(data), float(np.max(np.abs(expected - actual)))
+
+
+if __name__ == "__main__":
+    # python fast_inference.py ../data/get_around_pricing_project.csv
+    # python fast_inference.py ../data/get_around_pricing_project.csv --export compiled_model
+    parser = argparse.ArgumentParser(description="Check the compiled model against scikit-learn, and export it")
+    parser.add_argument("data", help="CSV file of cars to compare the predictions on")
+    parser.add_argument("--export", help="folder to export the compiled model to, served with COMPILED_MODEL_DIR")
+    args = parser.parse_args()
+
+    from model_registry import ModelRegistry
+
+    pickles = ModelRegistry(compiled_dir=None)  # the pickles even when serving an export
+    pickles.load()
+    model, preprocessor, _, _ = pickles.get()
+    rows, max_diff = check_parity(args.data, preprocessor, model)
+    print(f"{rows} rows compared, max absolute difference: {max_diff:.3g}")
+    ok = max_diff < 1e-6
+
+    if args.export:
+        import pandas as pd
+
+        pricer = CompiledPricer.from_sklearn(preprocessor, model)
+        pricer.save(args.export)
+        cars = pd.read_csv(args.data, index_col=0).drop(columns=["rental_price_per_day"], errors="ignore")
+        for column, table in pricer.categorical:
+            cars = cars[cars[column].isin(list(table))]
+        cars = cars.to_dict(orient="records")
+        # same parameters and same code: the exported model must give exactly the same prices
+        identical = np.array_equal(CompiledPricer.load(args.export).predict(cars), pricer.predict(cars))
+        print(f"exported to {args.export}, {len(cars)} rows predicted {'identically' if identical else 'DIFFERENTLY'}")
+        ok = ok and identical
+    sys.exit(0 if ok else 1)
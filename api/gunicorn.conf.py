@@ -0,0 +1,29 @@
+"""
+Gunicorn settings of the API, read by `gunicorn app:app` when started from this folder (as in the Dockerfile).
+
+The app is imported and the model unpickled once, in the master process, before the workers are forked:
+the workers start without importing scikit-learn or reading the pickles again, and share these pages
+with the master copy-on-write instead of each holding its own copy.
+GUNICORN_PRELOAD=0 imports the app and loads the model in each worker instead.
+"""
+import gc
+import os
+
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+# also load the pricing dataset of the search endpoints in the master, instead of on the first search of each worker
+PRELOAD_SEARCH_DATA = os.environ.get("PRELOAD_SEARCH_DATA", "0") == "1"
+
+
+def when_ready(server):
+    # runs in the master once the app is imported, before the first worker is forked
+    if not preload_app:
+        return
+    from model_registry import registry
+    registry.load()
+    if PRELOAD_SEARCH_DATA:
+        from app import pricing_table
+        pricing_table()
+    # objects created so far are left alone by the garbage collector: collections in the workers then do not
+    # write to the pages they share with the master
+    gc.freeze()
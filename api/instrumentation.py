@@ -0,0 +1,215 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+# per-endpoint and per-stage timings, off by default: every hook then returns right away
+METRICS = os.environ.get("METRICS", "0") == "1"
+# /debug/profile sampling profiler, off by default
+PROFILING = os.environ.get("PROFILING", "0") == "1"
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Per-bucket (not cumulative) counts plus the sum, count and max of the observed values."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count, histogram.sum, histogram.max = self.count, self.sum, self.max
+        return histogram
+
+    def to_dict(self):
+        labels = [str(bound) for bound in self.buckets] + ["+Inf"]
+        return {
+            "buckets": dict(zip(labels, self.counts)),
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+        }
+
+
+class Metrics:
+    """
+    Request latencies per endpoint, time spent in each stage of an operation (e.g. transform and model for
+    /predict) and requests in flight, rendered in the Prometheus text format by /metrics.
+
+    Stages are timed with laps: `t = metrics.clock()` at the start, then `t = metrics.lap(operation, stage, t)`
+    at the end of each stage. When disabled, clock() returns 0 and lap() returns right away, without reading
+    the clock nor taking the lock.
+    """
+
+    def __init__(self, enabled=METRICS):
+        self.enabled = enabled
+        self.latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # endpoint -> histogram
+        self.stages = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # (operation, stage) -> histogram
+        self.responses = Counter()  # (endpoint, status) -> count
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def clock(self):
+        return time.perf_counter() if self.enabled else 0.0
+
+    def lap(self, operation, stage, start):
+        """Record the time since `start` as a stage of the operation and return the current time."""
+        if not self.enabled:
+            return 0.0
+        now = time.perf_counter()
+        with self._lock:
+            self.stages[(operation, stage)].observe(now - start)
+        return now
+
+    def observe_request(self, endpoint, status, seconds):
+        with self._lock:
+            self.latency[endpoint].observe(seconds)
+            self.responses[(endpoint, status)] += 1
+
+    def snapshot(self):
+        """Copies of the histograms and counters taken under the lock, to be rendered without holding it."""
+        with self._lock:
+            return {
+                "latency": {endpoint: histogram.copy() for endpoint, histogram in self.latency.items()},
+                "stages": {key: histogram.copy() for key, histogram in self.stages.items()},
+                "responses": dict(self.responses),
+                "in_flight": self.in_flight,
+            }
+
+
+def labels(**values):
+    if not values:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in values.items()) + "}"
+
+
+def histogram_lines(name, histogram, **label_values):
+    """Prometheus lines of a Histogram: cumulative buckets, sum and count."""
+    lines, cumulated = [], 0
+    bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+    for bound, count in zip(bounds, histogram.counts):
+        cumulated += count
+        lines.append(f"{name}_bucket{labels(**label_values, le=bound)} {cumulated}")
+    lines.append(f"{name}_sum{labels(**label_values)} {histogram.sum}")
+    lines.append(f"{name}_count{labels(**label_values)} {histogram.count}")
+    return lines
+
+
+def render_prometheus(metrics, gauges, counters=None, histograms=None):
+    """
+    Text exposition of the metrics, followed by `gauges` and `counters`: {name: (help, value)} for the values
+    read from the other components (model, caches, executor) at the time of the request, and `histograms`:
+    {name: (help, Histogram)} for the distributions they record (e.g. the batch sizes of the micro-batcher).
+    """
+    lines = []
+    if metrics.enabled:
+        snapshot = metrics.snapshot()
+        lines += ["# HELP getaround_request_duration_seconds Time to answer a request, per endpoint",
+                  "# TYPE getaround_request_duration_seconds histogram"]
+        for endpoint, histogram in sorted(snapshot["latency"].items()):
+            lines += histogram_lines("getaround_request_duration_seconds", histogram, endpoint=endpoint)
+        lines += ["# HELP getaround_stage_duration_seconds Time spent in each stage of an operation",
+                  "# TYPE getaround_stage_duration_seconds histogram"]
+        for (operation, stage), histogram in sorted(snapshot["stages"].items()):
+            lines += histogram_lines("getaround_stage_duration_seconds", histogram, operation=operation, stage=stage)
+        lines += ["# HELP getaround_responses_total Responses sent, per endpoint and status code",
+                  "# TYPE getaround_responses_total counter"]
+        for (endpoint, status), count in sorted(snapshot["responses"].items()):
+            lines.append(f"getaround_responses_total{labels(endpoint=endpoint, status=status)} {count}")
+        lines += ["# HELP getaround_requests_in_flight Requests being processed",
+                  "# TYPE getaround_requests_in_flight gauge",
+                  f"getaround_requests_in_flight {snapshot['in_flight']}"]
+    for kind, values in (("gauge", gauges), ("counter", counters or {})):
+        for name, (description, value) in values.items():
+            if value is None:
+                continue
+            if kind == "counter":
+                name += "_total"
+            lines += [f"# HELP getaround_{name} {description}", f"# TYPE getaround_{name} {kind}",
+                      f"getaround_{name} {float(value)}"]
+    for name, (description, histogram) in (histograms or {}).items():
+        lines += [f"# HELP getaround_{name} {description}", f"# TYPE getaround_{name} histogram"]
+        lines += histogram_lines(f"getaround_{name}", histogram)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every HTTP request, labelled with the name of the endpoint function that handled it.
+    When metrics are disabled requests go straight to the app.
+    """
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        scope.setdefault("state", {})["metrics_start"] = start  # request.state.metrics_start in the endpoints
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.metrics.in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.metrics.in_flight -= 1
+            endpoint = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            self.metrics.observe_request(endpoint, status, time.perf_counter() - start)
+
+
+def sample_stacks(seconds, interval):
+    """
+    Sample the stacks of all the threads of the process every `interval` seconds for `seconds` seconds,
+    and return them in the folded format of flamegraph.pl and speedscope: one "frame;frame;frame count" line
+    per distinct stack, outermost frame first.
+    """
+    me = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            frames.append(names.get(ident, f"thread-{ident}"))
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+metrics = Metrics()
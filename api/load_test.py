@@ -0,0 +1,284 @@
+"""
+Load test of the API: latency and throughput of each scenario at increasing concurrency, the 429 and 504 answers,
+and the latency of /ready measured at the same time (it stays low when the blocking work is off the event loop).
+
+    python load_test.py http://localhost:4000 --scenarios search --concurrency 1 4 16 64
+    python load_test.py --mode inprocess --concurrency 1 8 32 --output results/inprocess.json
+    python load_test.py --mode gunicorn --workers 2 --output results/gunicorn.json --compare results/previous.json
+
+Given a URL it drives a running API; otherwise `inprocess` drives app.py through its ASGI interface (no network),
+and `uvicorn` and `gunicorn` start a local server and drive it over HTTP, also reporting the resident memory of each
+server process. The /predict and /predict/batch payloads are rows of the pricing dataset and the searches use its
+values, with a new seed at each concurrency so that a run does not replay the payloads cached by the previous one.
+The results can be saved with the current git commit to a JSON file, and `--compare` prints the change of latency
+and throughput against a previous file. Needs httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import httpx
+import numpy as np
+import pandas as pd
+
+TARGET = "rental_price_per_day"
+SCENARIOS = ("predict", "batch", "search", "aggregate", "policy")
+
+
+def workload(data, scenario, n, seed, batch_size=500):
+    """Requests of a scenario: /predict payloads from rows of the dataset, search queries on its values, policies."""
+    rng = random.Random(seed)
+    cars = data.drop(columns=[TARGET])
+
+    def search():
+        column = rng.choice(["fuel", "car_type", "model_key"])
+        value = rng.choice(data[column].unique().tolist())
+        return "GET", f"/search?{column}={value}&limit=50", None
+
+    def aggregate():
+        max_mileage = rng.randrange(20_000, 300_000, 10_000)
+        return "GET", f"/search?max_mileage={max_mileage}&aggregates=count,mean,median&group_by=car_type", None
+
+    def policy():
+        flexibility = rng.randrange(0, 720, 10)
+        return "POST", "/policy/evaluate", [{"threshold": t, "scope": "connect", "flexibility": flexibility}
+                                            for t in range(0, 720, 5)]
+
+    if scenario == "predict":
+        return [("POST", "/predict", car) for car in
+                cars.sample(n, replace=True, random_state=seed).to_dict(orient="records")]
+    if scenario == "batch":
+        return [("POST", "/predict/batch",
+                 cars.sample(batch_size, replace=True, random_state=seed * n + i).to_dict(orient="records"))
+                for i in range(n)]
+    return [{"search": search, "aggregate": aggregate, "policy": policy}[scenario]() for _ in range(n)]
+
+
+async def drive(client, requests, concurrency):
+    """Send the requests with `concurrency` of them in flight at once, return the latencies and statuses."""
+    latencies, statuses = [], []
+    pending = iter(requests)
+
+    async def user():
+        for method, path, body in pending:
+            start = time.perf_counter()
+            try:
+                status = (await client.request(method, path, json=body)).status_code
+            except httpx.TransportError:
+                status = None  # connection refused or reset, or no answer before the client timeout
+            latencies.append(time.perf_counter() - start)
+            statuses.append(status)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[user() for _ in range(concurrency)])
+    return np.array(latencies), statuses, time.perf_counter() - start
+
+
+async def probe_ready(client, done, interval=0.05):
+    """Latencies of /ready, called every `interval` seconds until `done` is set."""
+    latencies = []
+    while not done.is_set():
+        start = time.perf_counter()
+        try:
+            await client.get("/ready")
+        except httpx.TransportError:
+            pass
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+    return latencies
+
+
+def summary(latencies, statuses, elapsed, ready_latencies):
+    ok = np.array([status == 200 for status in statuses])
+    ms = latencies[ok] * 1000
+
+    def percentile(values, q):
+        return float(np.percentile(values, q)) if len(values) else None
+
+    return {
+        "requests": len(statuses),
+        "rps": int(ok.sum()) / elapsed,
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "mean_ms": float(ms.mean()) if len(ms) else None,
+        "429": statuses.count(429),
+        "504": statuses.count(504),
+        "other_errors": sum(status not in (200, 429, 504) for status in statuses),
+        "ready_p99_ms": percentile(np.array(ready_latencies) * 1000, 99),
+    }
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def process_tree(pid):
+    """pid and all its descendants (Linux /proc)."""
+    pids, todo = [], [pid]
+    while todo:
+        current = todo.pop()
+        pids.append(current)
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                todo += [int(child) for child in f.read().split()]
+        except OSError:
+            pass
+    return pids
+
+
+def memory(pid):
+    """Resident memory (MB) of each process of the server: master first, then its workers."""
+    return {str(p): rss_mb(p) for p in process_tree(pid)}
+
+
+def fmt(value, spec):
+    return "-" if value is None else format(value, spec)
+
+
+async def run_scenarios(client, data, args, server_pid=None):
+    """Every scenario at every concurrency; server_pid is None for a running API, whose memory is not reported."""
+    results = []
+    seed = 0
+    print(f"{'scenario':>10} {'concurrency':>11} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'429':>5} {'504':>5} {'errors':>6} {'/ready p99 ms':>13}")
+    for name in args.scenarios:
+        # warm up: data loading, first import of the search and delay modules
+        await drive(client, workload(data, name, args.warmup, seed, args.batch_size), 1)
+        for concurrency in args.concurrency:
+            seed += 1
+            requests = workload(data, name, args.requests, seed, args.batch_size)
+            done = asyncio.Event()
+            prober = asyncio.create_task(probe_ready(client, done))
+            latencies, statuses, elapsed = await drive(client, requests, concurrency)
+            done.set()
+            result = {"scenario": name, "concurrency": concurrency,
+                      **summary(latencies, statuses, elapsed, await prober),
+                      "rss_mb": memory(server_pid) if server_pid is not None else None}
+            results.append(result)
+            print(f"{name:>10} {concurrency:>11} {result['rps']:>8.1f} {fmt(result['p50_ms'], '>8.2f')} "
+                  f"{fmt(result['p95_ms'], '>8.2f')} {fmt(result['p99_ms'], '>8.2f')} {result['429']:>5} "
+                  f"{result['504']:>5} {result['other_errors']:>6} {fmt(result['ready_p99_ms'], '>13.1f')}")
+    return results
+
+
+async def bench_url(data, args):
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 1)  # one more for the /ready probe
+    async with httpx.AsyncClient(base_url=args.url.rstrip("/"), limits=limits, timeout=120) as client:
+        return await run_scenarios(client, data, args)
+
+
+async def bench_inprocess(data, args):
+    from app import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=120) as client:
+            return await run_scenarios(client, data, args, os.getpid())
+
+
+def server_command(args):
+    if args.mode == "uvicorn":
+        return [sys.executable, "-m", "uvicorn", "app:app", "--port", str(args.port), "--workers", str(args.workers),
+                "--log-level", "warning"]
+    return [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{args.port}", "--workers",
+            str(args.workers), "--worker-class", "uvicorn.workers.UvicornWorker", "--log-level", "warning"]
+
+
+async def bench_server(data, args):
+    server = subprocess.Popen(server_command(args))
+    base_url = f"http://127.0.0.1:{args.port}"
+    limits = httpx.Limits(max_connections=max(args.concurrency) + 1)
+    try:
+        async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+            deadline = time.monotonic() + 120
+            while True:
+                try:
+                    if (await client.get("/ready")).status_code == 200:
+                        break
+                except httpx.TransportError:
+                    pass
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError("The server did not start")
+                await asyncio.sleep(0.2)
+            return await run_scenarios(client, data, args, server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(results, previous_path):
+    with open(previous_path) as f:
+        previous = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    print(f"\nchange against {previous_path}:")
+    for result in results:
+        old = previous.get((result["scenario"], result["concurrency"]))
+        if old is None:
+            continue
+        changes = "  ".join(f"{metric} {(result[metric] / old[metric] - 1) * 100:+6.1f}%"
+                            for metric in ("rps", "p50_ms", "p99_ms") if result[metric] and old[metric])
+        print(f"{result['scenario']:>10} c={result['concurrency']:<4} {changes}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url", nargs="?", help="base URL of a running API (else the server of --mode is used)")
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn", "gunicorn"], default="inprocess")
+    parser.add_argument("--data", default="../data/get_around_pricing_project.csv", help="pricing dataset (CSV)")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=["predict", "search", "aggregate"])
+    parser.add_argument("--requests", type=int, default=1000, help="requests per scenario and concurrency")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, default=500, help="cars per request of the batch scenario")
+    parser.add_argument("--workers", type=int, default=1, help="server workers (uvicorn and gunicorn modes)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare with")
+    args = parser.parse_args()
+
+    # the search endpoints of a server started here read the same dataset as the payloads
+    os.environ.setdefault("PRICING_DATA_PATH", args.data)
+    data = pd.read_csv(args.data, index_col=0)
+
+    mode = "url" if args.url else args.mode
+    bench = {"url": bench_url, "inprocess": bench_inprocess}.get(mode, bench_server)
+    results = asyncio.run(bench(data, args))
+
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        report = {
+            "commit": git_commit(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "mode": mode,
+            "url": args.url,
+            "workers": args.workers if mode in ("uvicorn", "gunicorn") else None,
+            "requests": args.requests,
+            "cpu_count": os.cpu_count(),
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from executor import Overloaded
+from instrumentation import Histogram
+
+
+# upper bounds of the histogram buckets
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+WAIT_MS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100)
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-car predictions of a worker into one call of `score_rows`.
+
+    A request is queued with its own future; the batching loop waits at most `max_wait_ms`
+    after the first queued item (or until `max_batch_size` items are there), scores all of them
+    together and resolves each future with its own prediction.
+    `score_rows` takes a list of feature dicts and returns (predictions, errors) in the same order,
+    with None as prediction and a message as error for the rows that could not be scored.
+    It runs in `executor` (the default executor of the event loop if None) so the loop keeps serving requests.
+    At most `max_pending` rows wait in the queue: beyond that submit() raises Overloaded right away, like
+    BoundedExecutor.run does for the other endpoints.
+    """
+
+    def __init__(self, score_rows, max_wait_ms=5, max_batch_size=64, executor=None, max_pending=256):
+        self.score_rows = score_rows
+        self.executor = executor
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.rejected = 0
+        self.timed_out = 0
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.queue_wait_ms = Histogram(WAIT_MS_BUCKETS)
+        self._queue = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def submit(self, row, timeout=None):
+        """
+        Queue one feature dict and wait for its prediction.
+        Raises Overloaded when the queue is full and asyncio.TimeoutError after `timeout` seconds.
+        """
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((row, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise Overloaded(f"Too many predictions queued ({self.max_pending}), retry later")
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # the future is cancelled, its row is dropped from the batch if it was not scored yet
+            self.timed_out += 1
+            raise
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = [item for item in await self._collect() if not item[1].done()]
+            if not batch:
+                continue
+            now = time.perf_counter()
+            self.batch_sizes.observe(len(batch))
+            for _, _, queued_at in batch:
+                self.queue_wait_ms.observe((now - queued_at) * 1000)
+
+            try:
+                rows = [row for row, _, _ in batch]
+                predictions, errors = await asyncio.get_running_loop().run_in_executor(self.executor, self.score_rows, rows)
+            except Exception as e:
+                predictions, errors = [None] * len(batch), [str(e)] * len(batch)
+
+            for (_, future, _), pred, error in zip(batch, predictions, errors):
+                if future.done():  # the client went away
+                    continue
+                if pred is None:
+                    future.set_exception(ValueError(error))
+                else:
+                    future.set_result(pred)
+
+    def metrics(self):
+        return {
+            "max_wait_ms": self.max_wait * 1000,
+            "max_batch_size": self.max_batch_size,
+            "max_pending": self.max_pending,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "batch_size": self.batch_sizes.to_dict(),
+            "queue_wait_ms": self.queue_wait_ms.to_dict(),
+        }
@@ -1,7 +1,6 @@
 from sklearn.svm import SVR
-from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.base import BaseEstimator, TransformerMixin, clone
 from sklearn.preprocessing import StandardScaler
-import pandas as pd
 
 class SVR_with_InverseScaler(BaseEstimator):
     def __init__(self, scaler=StandardScaler(), svr=SVR(kernel='rbf', C=1, degree=3, gamma='scale', epsilon=0.1)):
@@ -17,4 +16,56 @@ class SVR_with_InverseScaler(BaseEstimator):
         scaled_predictions = self.svr.predict(X)
         unscaled_predictions = self.scaler.inverse_transform(scaled_predictions.reshape(-1, 1)).flatten()
         return unscaled_predictions
-    
+
+
+class KernelApprox_with_InverseScaler(BaseEstimator):
+    """
+    Faster alternative to SVR_with_InverseScaler: the RBF kernel is approximated with an explicit feature map
+    (Nystroem or random Fourier features) followed by a linear Ridge regression, so predicting costs
+    n_components operations per car instead of one kernel evaluation per support vector.
+    The target is scaled and unscaled the same way.
+    """
+    def __init__(self, scaler=StandardScaler(), method='nystroem', n_components=500, gamma='scale', alpha=1.0, random_state=0):
+        self.scaler = scaler
+        self.method = method
+        self.n_components = n_components
+        self.gamma = gamma
+        self.alpha = alpha
+        self.random_state = random_state
+
+    def _gamma(self, X):
+        if self.gamma != 'scale':
+            return self.gamma
+        # only needed to train, like the imports of fit
+        from scipy import sparse
+
+        # same value as SVR(gamma='scale'): 1 / (n_features * X.var())
+        if sparse.issparse(X):
+            var = X.multiply(X).mean() - X.mean() ** 2
+        else:
+            var = X.var()
+        return 1.0 / (X.shape[1] * var) if var != 0 else 1.0
+
+    def fit(self, X, y):
+        # only needed to train, not to load a trained model: the API does not import them at startup
+        from sklearn.kernel_approximation import Nystroem, RBFSampler
+        from sklearn.linear_model import Ridge
+
+        self.scaler_ = clone(self.scaler)
+        y_scaled = self.scaler_.fit_transform(y)  # Scale the target variable
+        gamma = self._gamma(X)
+        if self.method == 'nystroem':
+            self.feature_map_ = Nystroem(kernel='rbf', gamma=gamma, n_components=min(self.n_components, X.shape[0]),
+                                         random_state=self.random_state)
+        elif self.method == 'rff':
+            self.feature_map_ = RBFSampler(gamma=gamma, n_components=self.n_components, random_state=self.random_state)
+        else:
+            raise ValueError(f"Unknown method {self.method}, use 'nystroem' or 'rff'")
+        Z = self.feature_map_.fit_transform(X)
+        self.regressor_ = Ridge(alpha=self.alpha).fit(Z, y_scaled.ravel())
+        return self
+
+    def predict(self, X):
+        scaled_predictions = self.regressor_.predict(self.feature_map_.transform(X))
+        unscaled_predictions = self.scaler_.inverse_transform(scaled_predictions.reshape(-1, 1)).flatten()
+        return unscaled_predictions
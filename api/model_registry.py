@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+import time
+
+from fast_inference import CompiledPricer
+
+
+# which trained model to serve, each variant has its own pickle file (MODEL_PATH overrides it)
+MODEL_VARIANTS = {
+    "svr": "svr_model.pkl",  # SVR_with_InverseScaler, exact RBF kernel
+    "kernel_approx": "kernel_approx_model.pkl",  # KernelApprox_with_InverseScaler, faster
+}
+MODEL_VARIANT = os.environ.get("MODEL_VARIANT", "svr")
+if MODEL_VARIANT not in MODEL_VARIANTS:
+    raise ValueError(f"Unknown MODEL_VARIANT {MODEL_VARIANT!r}, expected one of {', '.join(MODEL_VARIANTS)}")
+MODEL_PATH = os.environ.get("MODEL_PATH", MODEL_VARIANTS[MODEL_VARIANT])
+PREPROCESSOR_PATH = os.environ.get("PREPROCESSOR_PATH", "preprocessor.pkl")
+# a version folder written by train.py (e.g. artifacts/latest), its manifest.json names the pickle files
+MODEL_DIR = os.environ.get("MODEL_DIR")
+# how often (in seconds) a worker checks MODEL_DIR or COMPILED_MODEL_DIR for a newer version
+RELOAD_CHECK_INTERVAL = float(os.environ.get("MODEL_RELOAD_CHECK_INTERVAL", "5"))
+# score with the plain NumPy version of the model when it can be compiled
+FAST_INFERENCE = os.environ.get("FAST_INFERENCE", "1") == "1"
+# a folder written by `python fast_inference.py <data> --export <folder>`: the compiled model is loaded from it,
+# memory-mapped, instead of unpickling the model and preprocessor (which are then not available)
+COMPILED_MODEL_DIR = os.environ.get("COMPILED_MODEL_DIR")
+
+
+# classes of model_definition that pickles made in a notebook or a script refer to as __main__.<name>
+MAIN_CLASSES = ("SVR_with_InverseScaler", "KernelApprox_with_InverseScaler")
+
+
+def load_pickle(path):
+    """
+    joblib.load, also for the pickles made in a notebook or a script, which refer to their classes as
+    __main__.SVR_with_InverseScaler: the classes of model_definition are then made available in __main__.
+    The shipped pickles and the ones written by train.py refer to model_definition directly.
+    """
+    # imported here, a server loading a compiled model (COMPILED_MODEL_DIR) does not need joblib
+    import joblib
+
+    try:
+        return joblib.load(path)
+    except AttributeError as e:
+        # Can't get attribute 'SVR_with_InverseScaler' on <module '__main__'>
+        if "__main__" not in str(e):
+            raise
+    import __main__
+    import model_definition
+
+    for name in MAIN_CLASSES:
+        if not hasattr(__main__, name):
+            setattr(__main__, name, getattr(model_definition, name))
+    return joblib.load(path)
+
+
+class ModelRegistry:
+    """
+    Holds the trained model and its preprocessor in memory so they are unpickled once
+    per worker instead of on every request.
+
+    The model, preprocessor, compiled model and version are stored as a single tuple, so swapping in a new version
+    is one reference assignment and a request never sees a new model with an old preprocessor, nor tags a price
+    with the version of a model that did not compute it.
+    Hot-swapping is only supported through a link that publishes a whole version at once: serve a folder written
+    by train.py (model_dir, e.g. artifacts/latest) and train a new version that `latest` then points to, and every
+    worker picks it up on its next check without being restarted.
+    With a compiled_dir, only the exported CompiledPricer is loaded and get() returns None as model and preprocessor;
+    a new export is published behind the link of the folder and picked up the same way.
+    Plain pickle paths are not watched: the model and the preprocessor are two files that cannot be replaced
+    together, so a worker could load a new model with the old preprocessor. POST /model/reload loads them again.
+    """
+
+    def __init__(self, model_path=MODEL_PATH, preprocessor_path=PREPROCESSOR_PATH,
+                 check_interval=RELOAD_CHECK_INTERVAL, model_dir=MODEL_DIR, compiled_dir=COMPILED_MODEL_DIR):
+        self.model_path = model_path
+        self.preprocessor_path = preprocessor_path
+        self.check_interval = check_interval
+        self.model_dir = model_dir
+        self.compiled_dir = compiled_dir
+        self.manifest = None
+        self._artifacts = None  # (model, preprocessor, pricer, version)
+        self._stamp = None  # modification times of the loaded files
+        self._last_check = 0.0
+        self._lock = threading.Lock()  # held while loading
+        self._check_lock = threading.Lock()  # held while deciding whether a check is due
+        self.version = 0
+        self.load_seconds = None
+
+    @property
+    def ready(self):
+        return self._artifacts is not None
+
+    def _file_stamp(self):
+        if self.compiled_dir is not None:
+            # a new export is a new folder, with a new pricer.json; load() reads the folder of the stamp
+            export_dir = os.path.realpath(self.compiled_dir)
+            stat = os.stat(os.path.join(export_dir, "pricer.json"))
+            return (export_dir, stat.st_ino, stat.st_mtime_ns)
+        if self.model_dir is not None:
+            # a new version always comes with a new manifest, written after the pickles; the link is resolved
+            # once, and load() reads the manifest and pickles from the version folder of the stamp
+            manifest_path = os.path.realpath(os.path.join(self.model_dir, "manifest.json"))
+            return (manifest_path, os.stat(manifest_path).st_mtime_ns)
+        if not os.path.exists(self.model_path):
+            # only svr_model.pkl is shipped, the other variants are trained with train.py
+            variant = {file: name for name, file in MODEL_VARIANTS.items()}.get(os.path.basename(self.model_path), "svr")
+            raise FileNotFoundError(
+                f"Model file {self.model_path} not found: train it with `python train.py --data "
+                f"../data/get_around_pricing_project.csv --model {variant}` and serve it with MODEL_DIR=artifacts/latest")
+        return (os.stat(self.model_path).st_mtime_ns, os.stat(self.preprocessor_path).st_mtime_ns)
+
+    @property
+    def watched(self):
+        """True if new versions are published behind a link (model_dir or compiled_dir), which the checks follow"""
+        return self.model_dir is not None or self.compiled_dir is not None
+
+    @staticmethod
+    def _read_manifest(version_dir):
+        """(manifest, model path, preprocessor path) of a version folder written by train.py"""
+        with open(os.path.join(version_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        return (manifest, os.path.join(version_dir, manifest["model_file"]),
+                os.path.join(version_dir, manifest["preprocessor_file"]))
+
+    def load(self, only_if_changed=False):
+        """
+        (Re)load both pickles from disk and swap them in. With only_if_changed, nothing is loaded if the files
+        are the ones already loaded: checked under the lock, so threads noticing the same new files at once
+        load them only once.
+        """
+        with self._lock:
+            start = time.perf_counter()
+            stamp = self._file_stamp()
+            if only_if_changed and stamp == self._stamp:
+                return self.version
+            if self.compiled_dir is not None:
+                model = preprocessor = None
+                pricer = CompiledPricer.load(stamp[0])
+            else:
+                manifest, model_path, preprocessor_path = self.manifest, self.model_path, self.preprocessor_path
+                if self.model_dir is not None:
+                    # not through the link: train.py may point `latest` to a new version between the reads
+                    manifest, model_path, preprocessor_path = self._read_manifest(os.path.dirname(stamp[0]))
+                model = load_pickle(model_path)
+                preprocessor = load_pickle(preprocessor_path)
+                pricer = None
+                # only once both pickles are loaded: status() never describes a version that failed to load
+                self.manifest, self.model_path, self.preprocessor_path = manifest, model_path, preprocessor_path
+            if FAST_INFERENCE and model is not None:
+                try:
+                    pricer = CompiledPricer.from_sklearn(preprocessor, model)
+                except ValueError:
+                    pass  # not a model the fast path knows, the sklearn objects are used
+            self.version += 1
+            self._artifacts = (model, preprocessor, pricer, self.version)
+            self._stamp = stamp
+            with self._check_lock:
+                self._last_check = time.monotonic()
+            self.load_seconds = time.perf_counter() - start
+        return self.version
+
+    def reload_if_changed(self):
+        """Reload the artifacts if the files on disk were replaced since the last load."""
+        try:
+            changed = self._file_stamp() != self._stamp
+        except OSError:
+            # the file is being replaced right now, keep serving the current version
+            return False
+        if not changed:
+            return False
+        try:
+            self.load(only_if_changed=True)
+        except Exception:
+            # a broken or half-written pickle must not take down a worker that is serving fine
+            return False
+        return True
+
+    def check_due(self):
+        """
+        True once every check_interval seconds: the caller then checks the files with reload_if_changed.
+        No I/O, so it can be called from the event loop. Never due for plain pickle paths, see the class docstring.
+        """
+        if self.check_interval < 0 or not self.watched:
+            return False
+        now = time.monotonic()
+        with self._check_lock:
+            if now - self._last_check <= self.check_interval:
+                return False
+            self._last_check = now
+            return True
+
+    def check_for_update(self):
+        """Reload the artifacts if the check interval has passed and the files on disk were replaced."""
+        if self.check_due():
+            self.reload_if_changed()
+
+    def get(self):
+        """
+        Return the current (model, preprocessor, pricer, version), pricer being the compiled version of the model
+        or None if it could not be compiled, and version the number of the load they come from.
+        """
+        if self._artifacts is None:
+            raise RuntimeError("The model is not loaded yet")
+        self.check_for_update()
+        return self._artifacts
+
+    def status(self):
+        return {
+            "ready": self.ready,
+            "version": self.version,
+            "model_path": self.model_path,
+            "preprocessor_path": self.preprocessor_path,
+            "load_seconds": self.load_seconds,
+            "fast_inference": self._artifacts is not None and self._artifacts[2] is not None,
+            "compiled_model_dir": self.compiled_dir,
+            "manifest": self.manifest,
+        }
+
+
+registry = ModelRegistry()
@@ -0,0 +1,122 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "10000"))  # 0 disables the cache
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", "3600"))  # seconds, 0 means no expiry
+PREDICTION_CACHE_MAX_BYTES = int(os.environ.get("PREDICTION_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+
+def cache_key(features):
+    """
+    Canonical, hashable form of a feature dict: fields sorted by name and numbers as floats,
+    so that e.g. a mileage of 30000 and 30000.0 hit the same entry.
+    """
+    items = []
+    for name in sorted(features):
+        value = features[name]
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = float(value)
+        items.append((name, value))
+    return tuple(items)
+
+
+def entry_size(key):
+    return sys.getsizeof(key) + sum(sys.getsizeof(item) + sys.getsizeof(item[1]) for item in key)
+
+
+class PredictionCache:
+    """
+    LRU cache of predictions, bounded in number of entries and in (approximate) memory, with an optional TTL.
+    Entries are tagged with the version of the model that produced them: when the model registry
+    swaps in a new model, the whole cache is dropped on the next access.
+    """
+
+    def __init__(self, max_entries=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL, max_bytes=PREDICTION_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (prediction, expiry time, size)
+        self._bytes = 0
+        self._model_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _check_version(self, model_version):
+        if model_version != self._model_version:
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self._bytes = 0
+            self._model_version = model_version
+
+    def get(self, key, model_version):
+        """Return the cached prediction or None."""
+        with self._lock:
+            self._check_version(model_version)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            prediction, expires_at, size = entry
+            if self.ttl and time.monotonic() > expires_at:
+                del self._entries[key]
+                self._bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return prediction
+
+    def put(self, key, prediction, model_version):
+        with self._lock:
+            if self._model_version is not None and model_version < self._model_version:
+                return  # computed by a model replaced since then
+            self._check_version(model_version)
+            size = entry_size(key)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (prediction, time.monotonic() + self.ttl, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or (self._bytes > self.max_bytes and len(self._entries) > 1):
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+
+prediction_cache = PredictionCache()
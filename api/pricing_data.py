@@ -0,0 +1,205 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+PRICING_DATA_PATH = os.environ.get("PRICING_DATA_PATH",
+                                   "https://jedha-getaround-project.s3.amazonaws.com/pricing_data_cleaned.csv")
+# how often (in seconds) a local file is checked for changes,
+# and after how long a remote file is downloaded again (0 means never)
+RELOAD_CHECK_INTERVAL = float(os.environ.get("PRICING_DATA_RELOAD_CHECK_INTERVAL", "5"))
+REMOTE_TTL = float(os.environ.get("PRICING_DATA_TTL", "0"))
+
+# columns that get a precomputed index of the rows of each value
+INDEXED_COLUMNS = ["model_key", "car_type", "fuel", "paint_color"]
+# numeric columns kept sorted for range filters
+RANGE_COLUMNS = ["mileage", "engine_power", "rental_price_per_day"]
+AGGREGATES = ["count", "mean", "median", "min", "max"]
+NO_ROWS = np.array([], dtype=np.intp)
+# number of rows serialized at once by streaming responses
+STREAM_BLOCK_SIZE = int(os.environ.get("STREAM_BLOCK_SIZE", "500"))
+
+
+def is_url(path):
+    return path.startswith(("http://", "https://", "s3://"))
+
+
+def read_pricing_csv(path):
+    """The pricing dataset, without the unnamed index column of a CSV written with its index (as in ../data)."""
+    frame = pd.read_csv(path)
+    return frame.loc[:, ~frame.columns.str.startswith("Unnamed:")]
+
+
+class PricingTable:
+    """
+    One loaded version of the pricing dataset: the columnar DataFrame plus, for every indexed column,
+    the row positions of each value, and for every range column the row positions sorted by value.
+    A search is then a dict lookup (or a binary search) and a `take` of those rows.
+    """
+
+    def __init__(self, frame, indexed_columns=INDEXED_COLUMNS, range_columns=RANGE_COLUMNS):
+        self.frame = frame
+        self._arrow = None
+        self.indexes = {column: frame.groupby(column, sort=False).indices for column in indexed_columns}
+        self.sorted_indexes = {}
+        for column in range_columns:
+            values = frame[column].to_numpy()
+            order = np.argsort(values, kind="stable")
+            self.sorted_indexes[column] = (values[order], order)
+
+    def positions(self, column, value):
+        """Positions of the rows where `column` equals `value`, in the order of the dataset."""
+        return self.indexes[column].get(value, NO_ROWS)
+
+    def range_positions(self, column, low=None, high=None):
+        """Positions of the rows where low <= `column` <= high (a missing bound is open), in no particular order."""
+        values, order = self.sorted_indexes[column]
+        start = 0 if low is None else np.searchsorted(values, low, side="left")
+        end = len(values) if high is None else np.searchsorted(values, high, side="right")
+        return order[start:end]
+
+    def filter(self, equals=None, ranges=None):
+        """
+        Positions of the rows matching all the filters, in the order of the dataset.
+        `equals` maps indexed columns to a value, `ranges` maps range columns to (low, high) bounds.
+        """
+        selections = [self.positions(column, value) for column, value in (equals or {}).items()]
+        selections += [self.range_positions(column, low, high) for column, (low, high) in (ranges or {}).items()]
+        if not selections:
+            return np.arange(len(self.frame))
+        if len(selections) == 1:
+            return np.sort(selections[0])
+
+        # intersect the selections as bitmaps, starting from the smallest one
+        selections.sort(key=len)
+        mask = np.zeros(len(self.frame), dtype=bool)
+        mask[selections[0]] = True
+        for selection in selections[1:]:
+            keep = np.zeros(len(self.frame), dtype=bool)
+            keep[selection] = True
+            mask &= keep
+        return np.flatnonzero(mask)
+
+    def aggregate(self, positions, aggregates, group_by=None, target="rental_price_per_day"):
+        """Aggregates of the target over the given rows, overall or per value of `group_by`."""
+        unknown = [aggregate for aggregate in aggregates if aggregate not in AGGREGATES]
+        if unknown:
+            raise ValueError(f"Unknown aggregates: {unknown}, allowed ones are {AGGREGATES}")
+        rows = self.frame.iloc[positions]
+        if group_by is None:
+            values = rows[target].agg(aggregates)
+            # an empty selection has no mean/median/min/max, NaN is not valid JSON
+            return {aggregate: int(value) if aggregate == "count" else None if pd.isna(value) else float(value)
+                    for aggregate, value in values.items()}
+        return rows.groupby(group_by)[target].agg(aggregates).to_dict(orient="index")
+
+    def columns(self, fields=None):
+        """Column positions of the requested fields (all columns if None)."""
+        if fields is None:
+            return np.arange(self.frame.shape[1])
+        unknown = [field for field in fields if field not in self.frame.columns]
+        if unknown:
+            raise ValueError(f"Unknown fields: {unknown}")
+        return self.frame.columns.get_indexer(fields)
+
+    def rows(self, positions, offset=0, limit=None, fields=None):
+        """One page of the given rows, with only the requested fields."""
+        end = None if limit is None else offset + limit
+        return self.frame.iloc[positions[offset:end], self.columns(fields)]
+
+    def sample(self, n):
+        """Positions of n rows drawn at random."""
+        return np.random.choice(len(self.frame), size=min(n, len(self.frame)), replace=False)
+
+    def arrow(self):
+        """The dataset as a pyarrow Table, converted from the DataFrame on the first Arrow or Parquet response."""
+        if self._arrow is None:
+            import pyarrow as pa
+            self._arrow = pa.Table.from_pandas(self.frame, preserve_index=False)
+        return self._arrow
+
+    def arrow_rows(self, positions, offset=0, limit=None, fields=None):
+        """Same rows as `rows`, taken column by column from the Arrow table."""
+        end = None if limit is None else offset + limit
+        return self.arrow().take(positions[offset:end]).select(self.columns(fields).tolist())
+
+    def iter_rows(self, positions, offset=0, limit=None, fields=None, block_size=STREAM_BLOCK_SIZE):
+        """Same rows as `rows`, yielded in blocks so a large result is never built at once."""
+        columns = self.columns(fields)
+        end = None if limit is None else offset + limit
+        positions = positions[offset:end]
+        for start in range(0, len(positions), block_size):
+            yield self.frame.iloc[positions[start:start + block_size], columns]
+
+
+class PricingData:
+    """
+    Loads the pricing dataset once per worker, from a local path or a URL, and keeps it in memory.
+    A local file is loaded again when it changes on disk, a remote one every `remote_ttl` seconds if set.
+    """
+
+    def __init__(self, path=PRICING_DATA_PATH, check_interval=RELOAD_CHECK_INTERVAL, remote_ttl=REMOTE_TTL):
+        self.path = path
+        self.check_interval = check_interval
+        self.remote_ttl = remote_ttl
+        self._table = None
+        self._stamp = None
+        self._loaded_at = 0.0
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def _file_stamp(self):
+        return None if is_url(self.path) else os.stat(self.path).st_mtime_ns
+
+    def _is_current(self, stamp, now):
+        """True if the loaded table is the one to serve: same file, or a remote one not older than remote_ttl."""
+        if self._table is None:
+            return False
+        if is_url(self.path):
+            return self.remote_ttl <= 0 or now - self._loaded_at <= self.remote_ttl
+        return stamp == self._stamp
+
+    def load(self, only_if_changed=False):
+        """
+        (Re)load the dataset. With only_if_changed, nothing is loaded if the loaded table is still current: checked
+        under the lock, so the requests arriving before the first load, or noticing the same change at once,
+        load it only once.
+        """
+        with self._lock:
+            stamp = self._file_stamp()
+            if only_if_changed and self._is_current(stamp, time.monotonic()):
+                return self._table
+            self._table = PricingTable(read_pricing_csv(self.path))
+            self._stamp = stamp
+            self._loaded_at = self._last_check = time.monotonic()
+        return self._table
+
+    def _is_stale(self, now):
+        if is_url(self.path):
+            return self.remote_ttl > 0 and now - self._loaded_at > self.remote_ttl
+        if now - self._last_check <= self.check_interval:
+            return False
+        self._last_check = now
+        try:
+            return self._file_stamp() != self._stamp
+        except OSError:
+            # the file is being replaced right now, keep serving the current version
+            return False
+
+    def get(self):
+        """Return the current PricingTable, loading or reloading it if needed."""
+        table = self._table
+        if table is None:
+            return self.load(only_if_changed=True)
+        if self._is_stale(time.monotonic()):
+            try:
+                return self.load(only_if_changed=True)
+            except Exception:
+                return table
+        return table
+
+
+pricing_data = PricingData()
@@ -0,0 +1,199 @@
+"""
+The endpoints of app.py, called through FastAPI's TestClient with the pickles and the pricing dataset of the repository.
+
+    cd api && python -m pytest
+"""
+import asyncio
+import os
+import time
+import warnings
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+import app as api
+from executor import BoundedExecutor
+from micro_batcher import MicroBatcher
+from test_fast_inference import CAR, DATA_PATH, HERE
+
+
+@pytest.fixture(scope="module")
+def client():
+    from pricing_data import pricing_data
+
+    with pytest.MonkeyPatch.context() as patch:
+        # the files of the repository, wherever pytest is started from
+        patch.setattr(pricing_data, "path", DATA_PATH)
+        patch.setattr(api.registry, "model_path", os.path.join(HERE, "svr_model.pkl"))
+        patch.setattr(api.registry, "preprocessor_path", os.path.join(HERE, "preprocessor.pkl"))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # pickled with an older scikit-learn
+            api.registry.load()
+        with TestClient(api.app) as client:
+            yield client
+
+
+def test_batch_reports_bad_items_at_their_index(client):
+    cars = [CAR, dict(CAR, mileage="far"), dict(CAR, model_key="Trabant"), 42, ["Porsche"], CAR]
+    response = client.post("/predict/batch", json=cars).json()
+    single = client.post("/predict", json=CAR).json()["prediction"]
+
+    assert response["predictions"] == [single, None, None, None, None, single]
+    assert [error["index"] for error in response["errors"]] == [1, 2, 3, 4]
+    assert response["errors"][0]["error"][0]["loc"][0] == "mileage"
+    assert "Trabant" in response["errors"][1]["error"]
+    # not an object: reported by the validation of the item, like a missing field
+    assert response["errors"][2]["error"][0]["type"] == "model_type"
+
+
+def test_empty_batch(client):
+    assert client.post("/predict/batch", json=[]).json() == {"predictions": [], "errors": []}
+
+
+@pytest.mark.parametrize("body", [CAR, "cars", 42])
+def test_batch_must_be_a_list(client, body):
+    assert client.post("/predict/batch", json=body).status_code == 422
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    return pd.read_csv(DATA_PATH, index_col=0)
+
+
+def test_search_combined_filters(client, dataset):
+    response = client.get("/search?fuel=diesel&car_type=suv&max_mileage=150000&min_engine_power=120"
+                          "&min_price=100&max_price=200&format=records&limit=10000")
+    expected = dataset[(dataset["fuel"] == "diesel") & (dataset["car_type"] == "suv")
+                       & (dataset["mileage"] <= 150000) & (dataset["engine_power"] >= 120)
+                       & dataset["rental_price_per_day"].between(100, 200)]
+    assert 0 < len(expected) < 1000
+    assert int(response.headers["X-Total-Count"]) == len(expected)
+    assert response.json() == expected.to_dict(orient="records")
+
+    # the same aggregates as pandas on the matching rows
+    response = client.get("/search?fuel=diesel&car_type=suv&max_mileage=150000&min_engine_power=120"
+                          "&min_price=100&max_price=200&aggregates=count,mean,max").json()
+    prices = expected["rental_price_per_day"]
+    assert response == {"count": len(prices), "mean": pytest.approx(prices.mean()), "max": prices.max()}
+
+
+def test_search_empty_aggregate(client):
+    query = "/search?car_type=van&min_price=10000&aggregates=count, mean,median"
+    assert client.get(query).json() == {"count": 0, "mean": None, "median": None}
+    assert client.get(query + "&group_by=fuel").json() == {}
+    # nothing to compute per group
+    assert "aggregates" in client.get("/search?car_type=van&group_by=fuel").json()["error"]
+
+
+def test_search_inverted_range(client):
+    response = client.get("/search?min_mileage=100000&max_mileage=1000&format=records")
+    assert response.json() == [] and response.headers["X-Total-Count"] == "0"
+    assert client.get("/search?min_price=200&max_price=100&aggregates=count").json() == {"count": 0}
+
+
+def cache_counts():
+    return api.prediction_cache.hits, api.prediction_cache.misses
+
+
+def test_prediction_cache_hit(client):
+    car = dict(CAR, mileage=123_456)
+    first = client.post("/predict", json=car).json()
+    hits, misses = cache_counts()
+    # same car, with the number written differently
+    assert client.post("/predict", json=dict(car, mileage=123_456.0)).json() == first
+    assert cache_counts() == (hits + 1, misses)
+
+
+def test_prediction_cache_expiry(client, monkeypatch):
+    monkeypatch.setattr(api.prediction_cache, "ttl", 0.5)
+    car = dict(CAR, mileage=123_457)
+    client.post("/predict", json=car)
+    client.post("/predict", json=car)
+    hits, misses = cache_counts()
+    expirations = api.prediction_cache.expirations
+    time.sleep(0.6)
+    client.post("/predict", json=car)
+    assert cache_counts() == (hits, misses + 1)
+    assert api.prediction_cache.expirations == expirations + 1
+
+
+def test_prediction_cache_miss_after_reload(client):
+    car = dict(CAR, mileage=123_458)
+    first = client.post("/predict", json=car).json()
+    client.post("/predict", json=car)
+    version = api.registry.version
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        assert client.post("/model/reload").json()["version"] == version + 1
+    hits, misses = cache_counts()
+    # priced again by the new version of the model, then cached for it
+    assert client.post("/predict", json=car).json() == first
+    assert cache_counts() == (hits, misses + 1)
+    client.post("/predict", json=car)
+    assert cache_counts() == (hits + 1, misses + 1)
+
+
+def test_overloaded_executor_answers_429(client, monkeypatch):
+    # no room for one more task: rejected before anything runs
+    full = BoundedExecutor(max_workers=1, max_pending=0)
+    monkeypatch.setattr(api, "executor", full)
+    for method, path, body in [("POST", "/predict", dict(CAR, mileage=123_459)), ("POST", "/predict/batch", [CAR]),
+                               ("GET", "/search?fuel=diesel", None), ("GET", "/preview", None)]:
+        response = client.request(method, path, json=body)
+        assert response.status_code == 429 and response.headers["Retry-After"] == "1"
+    assert full.stats()["rejected"] == 4
+
+
+def test_slow_request_answers_504(client, monkeypatch):
+    def slow_table():
+        time.sleep(0.5)
+        return table
+
+    table = api.pricing_table()
+    slow = BoundedExecutor(max_workers=1, max_pending=4)
+    monkeypatch.setattr(api, "executor", slow)
+    monkeypatch.setattr(api, "pricing_table", slow_table)
+    monkeypatch.setattr(api, "SEARCH_TIMEOUT", 0.05)
+    response = client.get("/search?fuel=diesel")
+    assert response.status_code == 504 and "too long" in response.json()["error"]
+    assert slow.stats()["timed_out"] == 1
+    slow.pool.shutdown(wait=True)
+    # the task is counted until its thread is done with it
+    assert slow.stats()["pending"] == 0
+
+
+def score_micro_batch(cars, max_batch_size=64):
+    """Submit the cars at once to a MicroBatcher scoring like /predict, return its results and batch sizes"""
+    async def submit_all():
+        batcher = MicroBatcher(api.score_queued, max_wait_ms=200, max_batch_size=max_batch_size)
+        batcher.start()
+        try:
+            results = await asyncio.gather(*[batcher.submit(car, timeout=10) for car in cars],
+                                           return_exceptions=True)
+        finally:
+            await batcher.stop()
+        return results, batcher.batch_sizes
+
+    return asyncio.run(submit_all())
+
+
+def test_micro_batch_gives_the_prices_of_predict(client):
+    cars = [dict(CAR, mileage=mileage) for mileage in range(10_000, 200_000, 10_000)]
+    results, batch_sizes = score_micro_batch(cars, max_batch_size=8)
+    # every car is scored, in batches of at most max_batch_size, and gets its own price
+    assert batch_sizes.count == 3 and batch_sizes.max == 8
+    assert [round(pred, 2) for pred, _ in results] == [client.post("/predict", json=car).json()["prediction"]
+                                                       for car in cars]
+    assert {version for _, version in results} == {api.registry.version}
+
+
+def test_bad_row_in_micro_batch(client):
+    cars = [CAR, dict(CAR, model_key="Trabant"), dict(CAR, mileage=float("nan")), dict(CAR, mileage=50_000)]
+    results, batch_sizes = score_micro_batch(cars)
+    assert batch_sizes.count == 1
+    # only the bad rows fail, with the error /predict answers for them
+    assert isinstance(results[1], ValueError) and "Trabant" in str(results[1])
+    assert isinstance(results[2], ValueError) and "NaN" in str(results[2])
+    assert round(results[0][0], 2) == client.post("/predict", json=CAR).json()["prediction"]
+    assert round(results[3][0], 2) == client.post("/predict", json=cars[3]).json()["prediction"]
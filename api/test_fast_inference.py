@@ -0,0 +1,103 @@
+"""
+CompiledPricer against preprocessor.transform + model.predict, on every car of the pricing dataset
+and on the inputs the sklearn path rejects.
+
+    cd api && python -m pytest
+"""
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fast_inference import CompiledPricer, check_parity
+from model_registry import ModelRegistry
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_PATH = os.path.join(HERE, "..", "data", "get_around_pricing_project.csv")
+
+CAR = {
+    "model_key": "Porsche", "mileage": 30000, "engine_power": 220, "fuel": "diesel", "paint_color": "black",
+    "car_type": "sedan", "private_parking_available": True, "has_gps": False, "has_air_conditioning": True,
+    "automatic_car": False, "has_getaround_connect": True, "has_speed_regulator": True, "winter_tires": True,
+}
+
+
+@pytest.fixture(scope="module")
+def sklearn_pair():
+    """(model, preprocessor) of the pickles shipped with the API"""
+    registry = ModelRegistry(os.path.join(HERE, "svr_model.pkl"), os.path.join(HERE, "preprocessor.pkl"),
+                             model_dir=None, compiled_dir=None)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # pickled with an older scikit-learn
+        registry.load()
+    model, preprocessor, _, _ = registry.get()
+    return model, preprocessor
+
+
+@pytest.fixture(scope="module")
+def pricer(sklearn_pair):
+    model, preprocessor = sklearn_pair
+    return CompiledPricer.from_sklearn(preprocessor, model)
+
+
+def sklearn_predict(sklearn_pair, rows):
+    model, preprocessor = sklearn_pair
+    return model.predict(preprocessor.transform(pd.DataFrame(rows)))
+
+
+def test_parity_on_dataset(sklearn_pair):
+    model, preprocessor = sklearn_pair
+    rows, max_diff = check_parity(DATA_PATH, preprocessor, model)
+    assert rows > 4800
+    assert max_diff < 1e-6
+
+
+def test_unknown_category(sklearn_pair, pricer):
+    car = dict(CAR, model_key="Trabant")
+    with pytest.raises(ValueError, match="unknown categories"):
+        sklearn_predict(sklearn_pair, [car])
+    with pytest.raises(ValueError, match=r"Found unknown categories \['Trabant'\] in column model_key"):
+        pricer.predict([car])
+
+
+@pytest.mark.parametrize("value, message", [(np.nan, "Input X contains NaN"),
+                                            (np.inf, "Input X contains infinity"),
+                                            (-np.inf, "Input X contains infinity")])
+def test_non_finite_numeric(sklearn_pair, pricer, value, message):
+    car = dict(CAR, mileage=value)
+    with pytest.raises(ValueError, match=message):
+        sklearn_predict(sklearn_pair, [car])
+    with pytest.raises(ValueError, match=message):
+        pricer.predict([car])
+    # in a batch, the other cars are not scored either: score_halves isolates the bad one
+    with pytest.raises(ValueError, match=message):
+        pricer.predict([CAR, car])
+
+
+def test_bool_columns(sklearn_pair, pricer):
+    bool_columns = [column for column, table in pricer.categorical if set(table) == {False, True}]
+    assert "has_gps" in bool_columns and "winter_tires" in bool_columns
+    # every value of every bool column, alone and as the integers 0 and 1 JSON clients may send
+    cars = [dict(CAR, **{column: value}) for column in bool_columns for value in (False, True, 0, 1)]
+    np.testing.assert_allclose(pricer.predict(cars), sklearn_predict(sklearn_pair, cars), rtol=0, atol=1e-6)
+    with pytest.raises(ValueError, match="unknown categories"):
+        pricer.predict([dict(CAR, has_gps="yes")])
+
+
+def test_export_gives_same_prices(pricer, tmp_path):
+    cars = pd.read_csv(DATA_PATH, index_col=0).drop(columns=["rental_price_per_day"]).head(200)
+    cars = cars[cars["model_key"].isin(list(dict(pricer.categorical)["model_key"]))].to_dict(orient="records")
+    directory = str(tmp_path / "compiled_model")
+    pricer.save(directory)
+    first = os.path.realpath(directory)
+    loaded = CompiledPricer.load(directory)
+    np.testing.assert_array_equal(loaded.predict(cars), pricer.predict(cars))
+
+    # each export is a new folder behind the link, the previous one is kept for the servers still loading it
+    pricer.save(directory)
+    pricer.save(directory)
+    assert os.path.islink(directory) and os.path.realpath(directory) != first
+    assert len(os.listdir(directory + ".versions")) == 2
+    np.testing.assert_array_equal(loaded.predict(cars), CompiledPricer.load(directory).predict(cars))
@@ -0,0 +1,57 @@
+"""
+PricingData loading the pricing dataset again when its file is replaced.
+
+    cd api && python -m pytest
+"""
+import os
+
+import pandas as pd
+
+from pricing_data import PricingData
+from test_fast_inference import DATA_PATH
+
+
+def write_rows(path, rows, mtime_ns):
+    rows.to_csv(path)
+    # the same file written twice within the resolution of the clock must still look changed
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_reload_when_file_changes(tmp_path):
+    data = pd.read_csv(DATA_PATH, index_col=0)
+    path = str(tmp_path / "pricing.csv")
+    write_rows(path, data.head(100), 1_000_000_000)
+
+    pricing_data = PricingData(path, check_interval=0)
+    first = pricing_data.get()
+    assert len(first.frame) == 100
+    assert pricing_data.get() is first  # unchanged file, not read again
+
+    write_rows(path, data.head(300), 2_000_000_000)
+    second = pricing_data.get()
+    assert second is not first and len(second.frame) == 300
+    assert len(second.positions("fuel", "diesel")) == (data.head(300)["fuel"] == "diesel").sum()
+
+
+def test_no_reload_before_check_interval(tmp_path):
+    data = pd.read_csv(DATA_PATH, index_col=0)
+    path = str(tmp_path / "pricing.csv")
+    write_rows(path, data.head(100), 1_000_000_000)
+
+    pricing_data = PricingData(path, check_interval=3600)
+    first = pricing_data.get()
+    write_rows(path, data.head(300), 2_000_000_000)
+    assert pricing_data.get() is first
+    # a forced load does not wait for the interval
+    assert len(pricing_data.load(only_if_changed=True).frame) == 300
+
+
+def test_keeps_serving_while_file_is_replaced(tmp_path):
+    data = pd.read_csv(DATA_PATH, index_col=0)
+    path = str(tmp_path / "pricing.csv")
+    write_rows(path, data.head(100), 1_000_000_000)
+
+    pricing_data = PricingData(path, check_interval=0)
+    first = pricing_data.get()
+    os.remove(path)
+    assert pricing_data.get() is first
@@ -0,0 +1,174 @@
+"""
+Train the pricing model and write a versioned set of artifacts the API can load.
+
+    python train.py --data ../data/get_around_pricing_project.csv --output-dir artifacts --n-jobs -1
+
+Each run writes artifacts/<version>/ with the model pickle, preprocessor.pkl and a manifest.json
+(feature schema, best hyperparameters, metrics, training time, data hash), and points artifacts/latest to it.
+Serve it with MODEL_DIR=artifacts/latest: the API reloads it when a new version is trained.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.compose import ColumnTransformer
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import GridSearchCV, train_test_split
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from sklearn.svm import SVR
+
+from model_definition import SVR_with_InverseScaler, KernelApprox_with_InverseScaler
+from model_registry import MODEL_VARIANTS
+
+TARGET = "rental_price_per_day"
+NUM_VARS = ["mileage", "engine_power"]
+CAT_VARS = ["model_key", "fuel", "paint_color", "car_type"]
+BOOL_VARS = ["private_parking_available", "has_gps", "has_air_conditioning", "automatic_car",
+             "has_getaround_connect", "has_speed_regulator", "winter_tires"]
+
+# hyperparameters tried by the grid search, for each model variant
+PARAM_GRIDS = {
+    "svr": {"model__svr__C": [0.5, 1, 2, 5], "model__svr__epsilon": [0.05, 0.1, 0.2]},
+    "kernel_approx": {"model__n_components": [300, 500, 1000], "model__alpha": [0.1, 1.0, 10.0]},
+}
+
+
+def make_preprocessor(data):
+    # same preprocessing as in notebooks/GetAroundAnalysis_ML.ipynb, with the categories of the whole dataset
+    # so that a rare category missing from a cross-validation fold is still known by its encoder
+    categories = [sorted(data[column].unique().tolist()) for column in CAT_VARS]
+    num_transformer = Pipeline([('scaler', StandardScaler())])
+    cat_transformer = Pipeline([('encoder', OneHotEncoder(categories=categories, drop='first'))])
+    bool_transformer = Pipeline([('encoder', OneHotEncoder(categories=[[False, True]] * len(BOOL_VARS), drop='if_binary'))])
+    return ColumnTransformer(
+        transformers=[
+            ('num', num_transformer, NUM_VARS),
+            ('cat', cat_transformer, CAT_VARS),
+            ('bool', bool_transformer, BOOL_VARS)
+        ])
+
+
+def make_model(variant):
+    if variant == "svr":
+        return SVR_with_InverseScaler(StandardScaler(), SVR(kernel='rbf', C=1, degree=3, gamma='scale', epsilon=0.1))
+    return KernelApprox_with_InverseScaler(StandardScaler())
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_data(path):
+    """Read the dataset, parsing only the columns used by the model."""
+    columns = NUM_VARS + CAT_VARS + BOOL_VARS + [TARGET]
+    return pd.read_csv(path, usecols=columns)[columns]
+
+
+def drop_rare_categories(data, min_count):
+    """Drop the cars of categories seen less than min_count times, too rare for the model to learn a price from."""
+    for column in CAT_VARS:
+        counts = data[column].value_counts()
+        data = data[data[column].isin(counts[counts >= min_count].index)]
+    return data
+
+
+def feature_schema(data):
+    schema = {}
+    for column in NUM_VARS:
+        schema[column] = {"type": "number", "min": float(data[column].min()), "max": float(data[column].max())}
+    for column in CAT_VARS:
+        schema[column] = {"type": "string", "categories": sorted(data[column].unique().tolist())}
+    for column in BOOL_VARS:
+        schema[column] = {"type": "boolean"}
+    return schema
+
+
+def point_latest(output_dir, version):
+    """Atomically point output_dir/latest to the new version."""
+    tmp = os.path.join(output_dir, "latest.tmp")
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(version, tmp)
+    os.replace(tmp, os.path.join(output_dir, "latest"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default="../data/get_around_pricing_project.csv", help="pricing dataset (CSV)")
+    parser.add_argument("--output-dir", default="artifacts")
+    parser.add_argument("--model", choices=sorted(PARAM_GRIDS), default="svr", help="model variant to train")
+    parser.add_argument("--min-category-count", type=int, default=1,
+                        help="drop the cars whose model, fuel, color or type appears fewer times")
+    parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--cv", type=int, default=5, help="number of cross-validation folds")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="parallel jobs of the grid search")
+    parser.add_argument("--random-state", type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    data_hash = file_sha256(args.data)
+    data = drop_rare_categories(read_data(args.data), args.min_category_count)
+    X, Y = data[NUM_VARS + CAT_VARS + BOOL_VARS], data[[TARGET]].astype(float)
+    X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=args.test_size, random_state=args.random_state)
+
+    # the preprocessor is part of the searched pipeline so that each fold is scaled with its own training rows
+    pipeline = Pipeline([('preprocessor', make_preprocessor(X)), ('model', make_model(args.model))])
+    search = GridSearchCV(pipeline, PARAM_GRIDS[args.model], cv=args.cv, n_jobs=args.n_jobs,
+                          scoring='neg_root_mean_squared_error')
+    search.fit(X_train, Y_train)
+
+    preds = search.best_estimator_.predict(X_test)
+    metrics = {
+        "cv_rmse": -search.best_score_,
+        "test_rmse": float(np.sqrt(mean_squared_error(Y_test, preds))),
+        "test_r2": float(r2_score(Y_test, preds)),
+    }
+
+    # the served model is trained on the entire dataset with the best hyperparameters
+    final = pipeline.set_params(**search.best_params_).fit(X, Y)
+    training_seconds = time.perf_counter() - start
+
+    version = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ") + "-" + data_hash[:8]
+    version_dir = os.path.join(args.output_dir, version)
+    os.makedirs(version_dir)
+    model_file = MODEL_VARIANTS[args.model]
+    joblib.dump(final.named_steps['model'], os.path.join(version_dir, model_file))
+    joblib.dump(final.named_steps['preprocessor'], os.path.join(version_dir, "preprocessor.pkl"))
+
+    manifest = {
+        "version": version,
+        "model_variant": args.model,
+        "model_class": type(final.named_steps['model']).__name__,
+        "model_file": model_file,
+        "preprocessor_file": "preprocessor.pkl",
+        "best_params": search.best_params_,
+        "metrics": metrics,
+        "training_seconds": training_seconds,
+        "data": {"path": args.data, "sha256": data_hash, "rows": len(data)},
+        "features": feature_schema(X),
+        "target": TARGET,
+        "sklearn_version": sklearn.__version__,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    with open(os.path.join(version_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    point_latest(args.output_dir, version)
+
+    print(f"version {version}: cv rmse {metrics['cv_rmse']:.2f}, test rmse {metrics['test_rmse']:.2f}, "
+          f"test r2 {metrics['test_r2']:.3f}, {training_seconds:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Delay workbook loading (delay_data) and minimum delay simulation (simulation) shared by the dashboard and the API."""
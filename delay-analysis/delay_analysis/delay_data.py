@@ -0,0 +1,229 @@
+import contextlib
+import hashlib
+import os
+import urllib.request
+import uuid
+
+import numpy as np
+import pandas as pd
+from pyarrow import feather
+
+try:
+    import fcntl
+except ImportError:  # Windows: the cache is built without a lock
+    fcntl = None
+
+
+DATA_URL = os.environ.get("DELAY_DATA_URL",
+                          "https://jedha-getaround-project.s3.amazonaws.com/get_around_delay_analysis.xlsx")
+# where the sheets of the workbook are saved as Feather files after the first load
+CACHE_DIR = os.environ.get("DELAY_CACHE_DIR", ".cache")
+SHEETS = ("rentals_data", "Documentation")
+
+
+def is_url(source):
+    return source.startswith(("http://", "https://"))
+
+
+def source_version(source):
+    """
+    Identifier of the current content of the data source, used as cache key:
+    ETag (or Last-Modified) of a URL, modification time and size of a local file.
+    None when the source can not be reached, the data is then loaded (or fails) as usual.
+    """
+    if not is_url(source):
+        try:
+            stat = os.stat(source)
+        except OSError:
+            return None
+        return f"{stat.st_mtime_ns}-{stat.st_size}"
+    request = urllib.request.Request(source, method="HEAD")
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.headers.get("ETag") or response.headers.get("Last-Modified")
+    except OSError:
+        return None
+
+
+def compact_rentals(data):
+    """Smallest dtypes holding the rentals: nullable ints for ids, categories for labels, float32 for minutes."""
+    data = data.copy()
+    for column in ['rental_id', 'car_id', 'previous_ended_rental_id']:
+        data[column] = data[column].astype('Int64')
+    for column in ['checkin_type', 'state']:
+        data[column] = data[column].astype('category')
+    for column in ['delay_at_checkout_in_minutes', 'time_delta_with_previous_rental_in_minutes']:
+        data[column] = data[column].astype('float32')
+    return data
+
+
+def build_cache(source, paths):
+    """
+    Parse the workbook once and write each sheet to its Feather file.
+    Each sheet is written to a temporary file of its own (process id and a random suffix) renamed into place,
+    so readers never see a partial file and writers never share one.
+    """
+    sheets = pd.read_excel(source, sheet_name=list(SHEETS))
+    sheets['rentals_data'] = compact_rentals(sheets['rentals_data'])
+    for sheet, path in paths.items():
+        tmp = f"{path}.{os.getpid()}-{uuid.uuid4().hex}.tmp"
+        try:
+            # uncompressed: read without decompressing, and iter_feather_chunks can memory-map it
+            sheets[sheet].to_feather(tmp, compression="uncompressed")
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    return sheets
+
+
+@contextlib.contextmanager
+def cache_lock(cache_dir, prefix):
+    """
+    Exclusive lock on the cached files of a source, held while they are built: the processes and threads
+    loading the same source at once wait for the first one instead of all parsing the workbook.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, f"{prefix}.lock"), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_cache(paths):
+    """
+    The cached sheets, or None if one of the files is missing (not built yet, or removed for a new version).
+    Read in full into pandas columns: the analysis needs NumPy arrays, so these are copies, not memory maps.
+    """
+    try:
+        return {sheet: pd.read_feather(path) for sheet, path in paths.items()}
+    except FileNotFoundError:
+        return None
+
+
+def load_sheets(source, version=None, cache_dir=CACHE_DIR):
+    """
+    Rentals and documentation sheets of the workbook.
+    The first load for a given version of the source converts the workbook to Feather files in cache_dir,
+    the following ones (also after a restart) read these files instead of parsing Excel again.
+    A new version of the source gets new files and the old ones are removed.
+    """
+    if version is None:
+        version = source_version(source)
+    if version is None:
+        # nothing to tell whether a cached copy is still valid
+        sheets = pd.read_excel(source, sheet_name=list(SHEETS))
+        return compact_rentals(sheets['rentals_data']), sheets['Documentation']
+
+    prefix = hashlib.sha1(source.encode()).hexdigest()[:12]
+    key = hashlib.sha1(str(version).encode()).hexdigest()[:12]
+    paths = {sheet: os.path.join(cache_dir, f"{prefix}-{key}-{sheet}.feather") for sheet in SHEETS}
+    sheets = read_cache(paths)
+    if sheets is None:
+        with cache_lock(cache_dir, prefix):
+            # built by another process or thread while this one waited for the lock
+            sheets = read_cache(paths)
+            if sheets is None:
+                # files of the other versions; the temporary files of other writers are left alone
+                current = {os.path.basename(path) for path in paths.values()}
+                for name in os.listdir(cache_dir):
+                    if name.startswith(prefix + "-") and name.endswith(".feather") and name not in current:
+                        os.remove(os.path.join(cache_dir, name))
+                sheets = build_cache(source, paths)
+    return sheets['rentals_data'], sheets['Documentation']
+
+
+class PreviousRentals:
+    """
+    Checkout delays of the rentals, looked up by integer rental id.
+    The ids are sorted once and each lookup is a binary search (np.searchsorted), so linking the rentals to their
+    previous rental needs two numeric columns in memory instead of a hash join on the whole table.
+    """
+
+    def __init__(self, rental_ids, delays):
+        rental_ids = np.asarray(rental_ids, dtype=np.int64)
+        order = np.argsort(rental_ids, kind="stable")
+        self.ids = rental_ids[order]
+        self.delays = np.asarray(delays)[order]
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """From an iterable of rentals DataFrames, keeping only their ids and delays."""
+        ids, delays = [], []
+        for chunk in chunks:
+            ids.append(chunk['rental_id'].to_numpy(dtype=np.int64))
+            delays.append(chunk['delay_at_checkout_in_minutes'].to_numpy())
+        return cls(np.concatenate(ids), np.concatenate(delays))
+
+    def lookup(self, previous_ids):
+        """Checkout delay of the rental of each id, NaN for a missing id or an unknown rental."""
+        previous_ids = pd.array(previous_ids, dtype='Int64')
+        known = ~np.asarray(previous_ids.isna())
+        keys = previous_ids.to_numpy(dtype=np.int64, na_value=0)
+        positions = np.minimum(np.searchsorted(self.ids, keys), len(self.ids) - 1)
+        found = known & (self.ids[positions] == keys) if len(self.ids) else np.zeros(len(keys), dtype=bool)
+        dtype = np.result_type(self.delays.dtype, np.float32)
+        return np.where(found, self.delays[positions] if len(self.ids) else np.nan, np.nan).astype(dtype)
+
+
+def add_features(data, previous=None):
+    """
+    Columns derived for the analysis, all computed column-wise:
+    - second_rental: 1 if the rental follows another one on the same car
+    - previous_drivers_delay_in_mins: checkout delay of the previous rental of the car
+    - minutes_passed_checkin_time: how late the car was for this checkin (negative if it was back in time)
+    - is_late_for_next_checkin: 'late', 'not late' or NaN when unknown
+    The previous rentals are looked up in `previous` (a PreviousRentals), by default built from data itself;
+    pass the one of the whole log when data is one chunk of it.
+    """
+    if previous is None:
+        previous = PreviousRentals(data['rental_id'], data['delay_at_checkout_in_minutes'])
+    data = data.copy()
+    data['second_rental'] = np.where(data['time_delta_with_previous_rental_in_minutes'].isna(), 0, 1)
+    data['previous_drivers_delay_in_mins'] = previous.lookup(data['previous_ended_rental_id'])
+    data['minutes_passed_checkin_time'] = data['previous_drivers_delay_in_mins'] - data['time_delta_with_previous_rental_in_minutes']
+
+    is_late = pd.Series(np.nan, index=data.index, dtype=object)
+    is_late[data['minutes_passed_checkin_time'] > 0] = 'late'
+    is_late[data['minutes_passed_checkin_time'] < 0] = 'not late'
+    data['is_late_for_next_checkin'] = is_late
+    return data
+
+
+def iter_feather_chunks(path, chunk_rows=1_000_000):
+    """Rentals of a Feather file, chunk_rows at a time, read from a memory map."""
+    table = feather.read_table(path, memory_map=True)
+    for batch in table.to_batches(max_chunksize=chunk_rows):
+        yield batch.to_pandas()
+
+
+def iter_features(read_chunks):
+    """
+    add_features for a rentals log too large to be loaded at once. read_chunks() returns an iterator over
+    its chunks (e.g. lambda: iter_feather_chunks(path)) and is called twice: a first pass keeps the ids and
+    delays of all the rentals, the second one yields each chunk with its derived columns.
+    """
+    previous = PreviousRentals.from_chunks(read_chunks())
+    for chunk in read_chunks():
+        yield add_features(chunk, previous)
+
+
+def delay_histograms(data, delay_edges, time_delta_edges):
+    """
+    Number of consecutive rentals in each (previous driver's delay, time delta) bin, per state of the rental:
+    {state: counts of shape (len(delay_edges) - 1, len(time_delta_edges) - 1)}.
+    Delays outside the edges are counted in the first or last bin, so the result has the same size
+    whatever the number of rentals.
+    """
+    known = data['previous_drivers_delay_in_mins'].notna() & data['time_delta_with_previous_rental_in_minutes'].notna()
+    delay = np.clip(data.loc[known, 'previous_drivers_delay_in_mins'].to_numpy(dtype=float), delay_edges[0], delay_edges[-1])
+    time_delta = np.clip(data.loc[known, 'time_delta_with_previous_rental_in_minutes'].to_numpy(dtype=float),
+                         time_delta_edges[0], time_delta_edges[-1])
+    state = data.loc[known, 'state'].to_numpy()
+    return {value: np.histogram2d(delay[state == value], time_delta[state == value],
+                                  bins=[delay_edges, time_delta_edges])[0].astype(np.int32)
+            for value in ['ended', 'canceled']}
@@ -0,0 +1,334 @@
+import argparse
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+SCOPES = ("all", "connect", "mobile")
+
+
+def process_pool(workers=None):
+    """
+    Pool of processes for DelaySimulation.bootstrap, started with forkserver (spawn where it does not exist) instead
+    of fork: forking a multi-threaded server such as Streamlit's can deadlock the children.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(workers or os.cpu_count() or 1, mp_context=multiprocessing.get_context(method))
+
+
+def count_below(sorted_values, thresholds):
+    """For each threshold, the number of values strictly below it."""
+    return np.searchsorted(sorted_values, thresholds, side="left")
+
+
+def weighted_count_below(values, weights, thresholds):
+    """
+    For each row of weights (one per resample) and each threshold, the total weight of the values strictly below it:
+    the values are sorted once and the cumulated weights of every resample are read at the same positions.
+    """
+    order = np.argsort(values, kind="stable")
+    cumulated = np.zeros((weights.shape[0], len(values) + 1))
+    np.cumsum(weights[:, order], axis=1, out=cumulated[:, 1:])
+    return cumulated[:, count_below(values[order], thresholds)]
+
+
+def _bootstrap_curves(checkin_type, time_delta, previous_delay, thresholds, flexibility, n_resamples, seed):
+    """
+    Solved and profit curves of n_resamples bootstrap resamples of the consecutive rentals, per scope.
+    A resample is a row of multinomial weights (how many times each rental is drawn), so all the resamples are
+    computed together as weighted counts of the same sorted values.
+    """
+    n = len(time_delta)
+    weights = np.random.default_rng(seed).multinomial(n, np.full(n, 1.0 / n), size=n_resamples).astype(float)
+    passed_checkin = previous_delay - time_delta
+    late, not_late = passed_checkin > 0, passed_checkin < 0
+    limit = time_delta + flexibility
+    solvable = late & (previous_delay < limit)
+
+    solved, still_successful, not_late_count = {}, {}, {}
+    for scope in SCOPES:
+        in_scope = np.ones(n, dtype=bool) if scope == "all" else checkin_type == scope
+        rows = late & in_scope
+        solved[scope] = weighted_count_below(previous_delay[rows], weights[:, rows], thresholds)
+        rows = not_late & in_scope
+        not_late_count[scope] = weights[:, rows].sum(axis=1)[:, None]
+        kept_not_late = not_late_count[scope] - weighted_count_below(limit[rows], weights[:, rows], thresholds)
+        rows = solvable & in_scope
+        solved_late = (weighted_count_below(previous_delay[rows], weights[:, rows], thresholds)
+                       - weighted_count_below(limit[rows], weights[:, rows], thresholds))
+        still_successful[scope] = kept_not_late + solved_late
+
+    profit = {
+        "all": still_successful["all"],
+        "connect": still_successful["connect"] + not_late_count["mobile"],
+        "mobile": still_successful["mobile"] + not_late_count["connect"],
+    }
+    return solved, profit
+
+
+class DelaySimulation:
+    """
+    Counterfactual outcomes of a minimum delay between two rentals, for every threshold at once.
+
+    Built from one entry per rental: its checkin type, the time delta with the previous rental of the car
+    (NaN if there is none) and the checkout delay of the previous driver (NaN if unknown).
+    The relevant values of each scope are sorted once, then every curve is a `np.searchsorted` of the
+    thresholds into them: O(rows log rows) to build, O(thresholds log rows) per curve, instead of
+    one pass over the rentals per threshold and scope.
+    """
+
+    def __init__(self, checkin_type, time_delta, previous_delay):
+        checkin_type = np.asarray(checkin_type)
+        time_delta = np.asarray(time_delta, dtype=float)
+        previous_delay = np.asarray(previous_delay, dtype=float)
+
+        consecutive = ~np.isnan(time_delta)
+        passed_checkin = previous_delay - time_delta  # NaN when the previous delay is unknown
+        late = passed_checkin > 0
+        not_late = passed_checkin < 0
+
+        self.time_delta = {}  # time deltas of the consecutive rentals
+        self.late_delay = {}  # delays of the previous drivers who were late for the next checkin
+        self.late_time_delta = {}  # time deltas of these same rentals
+        self.not_late_time_delta = {}  # time deltas of the consecutive rentals where the car was back on time
+        self.late_count = {}
+        self.not_late_count = {}
+        for scope in SCOPES:
+            in_scope = np.ones(len(checkin_type), dtype=bool) if scope == "all" else checkin_type == scope
+            self.time_delta[scope] = np.sort(time_delta[consecutive & in_scope])
+            order = np.argsort(previous_delay[late & in_scope], kind="stable")
+            self.late_delay[scope] = previous_delay[late & in_scope][order]
+            self.late_time_delta[scope] = time_delta[late & in_scope][order]
+            self.not_late_time_delta[scope] = np.sort(time_delta[not_late & in_scope])
+            self.late_count[scope] = int((late & in_scope).sum())
+            self.not_late_count[scope] = int((not_late & in_scope).sum())
+
+        # the consecutive rentals themselves, resampled by bootstrap()
+        self.consecutive = (checkin_type[consecutive], time_delta[consecutive], previous_delay[consecutive])
+
+    @classmethod
+    def from_frame(cls, data):
+        """From the rentals table enriched with `previous_drivers_delay_in_mins`."""
+        return cls(data["checkin_type"].to_numpy(),
+                   data["time_delta_with_previous_rental_in_minutes"].to_numpy(dtype=float),
+                   data["previous_drivers_delay_in_mins"].to_numpy(dtype=float))
+
+    def solved(self, thresholds):
+        """Number of late-for-next-checkin cases a threshold would have avoided (previous delay below it), per scope."""
+        thresholds = np.asarray(thresholds)
+        return {scope: count_below(self.late_delay[scope], thresholds) for scope in SCOPES}
+
+    def affected(self, thresholds, flexibility=0):
+        """
+        Number of consecutive rentals that would not have been allowed, per scope:
+        the ones planned less than `threshold - flexibility` minutes after the previous checkout.
+        """
+        thresholds = np.asarray(thresholds)
+        return {scope: count_below(self.time_delta[scope], thresholds - flexibility) for scope in SCOPES}
+
+    def _still_successful(self, scope, thresholds, flexibility):
+        # rentals with the car back on time are kept as long as the threshold is within the customer's flexibility
+        not_late = self.not_late_time_delta[scope]
+        kept_not_late = len(not_late) - count_below(not_late + flexibility, thresholds)
+
+        # late cases become successful when the threshold is above the delay and still within the flexibility,
+        # i.e. for delay < threshold <= time delta + flexibility: count the intervals containing each threshold
+        delay, limit = self.late_delay[scope], self.late_time_delta[scope] + flexibility
+        non_empty = delay < limit
+        solved_late = count_below(delay[non_empty], thresholds) - count_below(np.sort(limit[non_empty]), thresholds)
+        return kept_not_late + solved_late
+
+    def profit(self, thresholds, flexibility=0):
+        """
+        Number of non-problematic consecutive rentals we would have had, per scope, with customers accepting
+        to pick up the car up to `flexibility` minutes after the time they asked for.
+        For the connect (mobile) scope the rentals of the other checkin type are unchanged and counted as they are.
+        """
+        thresholds = np.asarray(thresholds)
+        return {
+            "all": self._still_successful("all", thresholds, flexibility),
+            "connect": self._still_successful("connect", thresholds, flexibility) + self.not_late_count["mobile"],
+            "mobile": self._still_successful("mobile", thresholds, flexibility) + self.not_late_count["connect"],
+        }
+
+    def evaluate(self, policies):
+        """
+        Outcomes of a list of (threshold, scope, flexibility) policies, in the same order: problematic cases
+        solved, rentals blocked and non-problematic consecutive rentals. The policies sharing a flexibility
+        are computed together, as one vectorized call per curve.
+        """
+        policies = list(policies)
+        by_flexibility = {}
+        for i, (threshold, scope, flexibility) in enumerate(policies):
+            if scope not in SCOPES:
+                raise ValueError(f"Unknown scope {scope!r}, expected one of {', '.join(SCOPES)}")
+            by_flexibility.setdefault(flexibility, []).append(i)
+
+        results = [None] * len(policies)
+        for flexibility, indices in by_flexibility.items():
+            thresholds = np.array([policies[i][0] for i in indices], dtype=float)
+            solved = self.solved(thresholds)
+            blocked = self.affected(thresholds, flexibility)
+            successful = self.profit(thresholds, flexibility)
+            for j, i in enumerate(indices):
+                scope = policies[i][1]
+                results[i] = {"solved": int(solved[scope][j]), "blocked": int(blocked[scope][j]),
+                              "successful": int(successful[scope][j])}
+        return results
+
+    def bootstrap(self, thresholds, flexibility=0, n_resamples=1000, confidence=0.9, workers=None, seed=0,
+                  chunk_size=100, pool=None):
+        """
+        Bootstrap confidence bands of the solved and profit curves: the consecutive rentals are resampled with
+        replacement n_resamples times, and the bands are the percentiles of the curves over the resamples.
+        Returns {"solved": {scope: (low, high)}, "profit": {scope: (low, high)}}.
+
+        The resamples are split in chunks of chunk_size computed by a pool of `workers` processes (all the CPUs
+        by default, 1 computes them in this process); the result only depends on the seed, not on the workers.
+        A long-lived `pool` (see process_pool) can be given instead, so that each call does not start processes.
+        """
+        thresholds = np.asarray(thresholds, dtype=float)
+        workers = workers or os.cpu_count() or 1
+        chunks = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        args = [(*self.consecutive, thresholds, flexibility, size, chunk_seed) for size, chunk_seed in zip(chunks, seeds)]
+        if pool is not None:
+            results = list(pool.map(_bootstrap_curves, *zip(*args)))
+        elif workers == 1 or len(chunks) == 1:
+            results = [_bootstrap_curves(*arg) for arg in args]
+        else:
+            with process_pool(workers) as own_pool:
+                results = list(own_pool.map(_bootstrap_curves, *zip(*args)))
+
+        alpha = (1 - confidence) / 2 * 100
+        bands = {}
+        for i, curve in enumerate(("solved", "profit")):
+            bands[curve] = {}
+            for scope in SCOPES:
+                resamples = np.concatenate([result[i][scope] for result in results])
+                low, high = np.percentile(resamples, [alpha, 100 - alpha], axis=0)
+                bands[curve][scope] = (low, high)
+        return bands
+
+    def breakpoints(self, scope, flexibility=0):
+        """
+        Thresholds where the number of successful rentals of a scope can change: between two consecutive
+        breakpoints it is constant and equal to its value at the upper one, so these (and 0) are the only
+        thresholds worth evaluating.
+        """
+        values = np.concatenate([[0.0], self.not_late_time_delta[scope] + flexibility,
+                                 self.late_delay[scope], self.late_time_delta[scope] + flexibility])
+        return np.unique(values[values >= 0])
+
+    def policy_options(self, flexibility=0, rental_value=None, separate=False, max_threshold=None):
+        """
+        Best threshold of each scope for customers accepting to wait `flexibility` minutes: "all" (one threshold
+        for every car), "connect" or "mobile" (the other cars keep no threshold), and with `separate` "separate"
+        (one threshold for connect cars and another one for mobile cars).
+
+        The value of a policy is the number of non-problematic consecutive rentals, each one weighted by the
+        value of a rental of its checkin type in `rental_value` (1 by default, e.g. {"connect": 1.2}).
+        Only the breakpoints up to `max_threshold` are evaluated, and the smallest of the best thresholds (in whole
+        minutes) is kept.
+        Returns one dict per scope with the thresholds per checkin type, the successful rentals and the value.
+        """
+        value = {"connect": 1.0, "mobile": 1.0, **(rental_value or {})}
+
+        def candidates(types):
+            thresholds = np.unique(np.concatenate([self.breakpoints(t, flexibility) for t in types]))
+            if max_threshold is not None:
+                thresholds = np.append(thresholds[thresholds < max_threshold], max_threshold)
+            return thresholds
+
+        def best(types):
+            # best threshold applied to the cars of these checkin types, and the successful rentals per type
+            thresholds = candidates(types)
+            successful = {t: self._still_successful(t, thresholds, flexibility) for t in types}
+            i = int(np.argmax(sum(value[t] * successful[t] for t in types)))
+            # the value is the same for every threshold of (previous breakpoint, breakpoint]: the smallest
+            # whole number of minutes of this interval blocks the fewest rentals for it
+            threshold = thresholds[i] if i == 0 else min(np.floor(thresholds[i - 1]) + 1, thresholds[i])
+            return float(threshold), {t: int(successful[t][i]) for t in types}
+
+        no_threshold = {t: int(self._still_successful(t, np.zeros(1), flexibility)[0]) for t in ("connect", "mobile")}
+        policies = []
+        threshold, successful = best(("connect", "mobile"))
+        policies.append(("all", {"connect": threshold, "mobile": threshold}, successful))
+        for scope, other in (("connect", "mobile"), ("mobile", "connect")):
+            threshold, successful = best((scope,))
+            thresholds = {"connect": 0.0, "mobile": 0.0, scope: threshold}
+            policies.append((scope, thresholds, {**successful, other: no_threshold[other]}))
+        if separate:
+            (connect, connect_successful), (mobile, mobile_successful) = best(("connect",)), best(("mobile",))
+            policies.append(("separate", {"connect": connect, "mobile": mobile}, {**connect_successful, **mobile_successful}))
+
+        return [{"scope": scope, "thresholds": thresholds, "successful": sum(successful.values()),
+                 "value": sum(value[t] * successful[t] for t in successful)}
+                for scope, thresholds, successful in policies]
+
+    def best_policy(self, flexibility=0, rental_value=None, separate=False, max_threshold=None):
+        """The option of policy_options with the highest value (the simplest scope on a tie)."""
+        return max(self.policy_options(flexibility, rental_value, separate, max_threshold), key=lambda p: p["value"])
+
+
+class SensitivityGrid:
+    """
+    One curve of a DelaySimulation ("affected" or "profit") for every (flexibility, threshold, scope),
+    kept in a single (flexibilities, thresholds, scopes) int32 array.
+
+    A row (one flexibility) is computed the first time it is asked for and memoized, so moving a slider back
+    to a value already seen is a lookup; fill() computes all the remaining rows at once.
+    """
+
+    def __init__(self, simulation, metric, thresholds, flexibilities):
+        self.curve = getattr(simulation, metric)
+        self.thresholds = np.asarray(thresholds)
+        self.flexibilities = np.asarray(flexibilities)
+        self.values = np.zeros((len(self.flexibilities), len(self.thresholds), len(SCOPES)), dtype=np.int32)
+        self.filled = np.zeros(len(self.flexibilities), dtype=bool)
+
+    def _row(self, flexibility):
+        i = int(np.searchsorted(self.flexibilities, flexibility))
+        if i == len(self.flexibilities) or self.flexibilities[i] != flexibility:
+            raise ValueError(f"Flexibility {flexibility} is not in the grid")
+        if not self.filled[i]:
+            curves = self.curve(self.thresholds, flexibility)
+            self.values[i] = np.stack([curves[scope] for scope in SCOPES], axis=-1)
+            self.filled[i] = True
+        return i
+
+    def get(self, flexibility):
+        """Curves of a flexibility of the grid, per scope (views on the grid)."""
+        i = self._row(flexibility)
+        return {scope: self.values[i, :, k] for k, scope in enumerate(SCOPES)}
+
+    def fill(self):
+        """Compute every row not computed yet, e.g. to build the whole grid offline and np.save(grid.values)."""
+        for flexibility in self.flexibilities[~self.filled]:
+            self._row(flexibility)
+        return self.values
+
+
+if __name__ == "__main__":
+    # python -m delay_analysis.simulation ../data/get_around_delay_analysis.xlsx --flexibility 0 60 120 --separate
+    from delay_analysis.delay_data import add_features, load_sheets
+
+    parser = argparse.ArgumentParser(description="Best minimum delay between two rentals for each flexibility")
+    parser.add_argument("source", help="delay workbook (path or URL)")
+    parser.add_argument("--flexibility", type=float, nargs="+", default=[0], help="minutes customers accept to wait")
+    parser.add_argument("--connect-value", type=float, default=1.0, help="value of a connect rental")
+    parser.add_argument("--mobile-value", type=float, default=1.0, help="value of a mobile rental")
+    parser.add_argument("--separate", action="store_true", help="also try separate connect and mobile thresholds")
+    parser.add_argument("--max-threshold", type=float, default=None)
+    args = parser.parse_args()
+
+    rentals, _ = load_sheets(args.source)
+    simulation = DelaySimulation.from_frame(add_features(rentals))
+    rental_value = {"connect": args.connect_value, "mobile": args.mobile_value}
+    for flexibility in args.flexibility:
+        policy = simulation.best_policy(flexibility, rental_value, args.separate, args.max_threshold)
+        print(f"flexibility {flexibility:g}: scope {policy['scope']}, connect threshold "
+              f"{policy['thresholds']['connect']:g}, mobile threshold {policy['thresholds']['mobile']:g}, "
+              f"{policy['successful']} successful rentals, value {policy['value']:g}")
@@ -0,0 +1,96 @@
+"""
+add_features and PreviousRentals against the merge on string ids the dashboard used to link each rental to its
+previous one (kept below as the reference), on a small fixed rentals log.
+
+    cd delay-analysis && python -m pytest
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from delay_analysis.delay_data import PreviousRentals, add_features, iter_features
+
+
+@pytest.fixture(scope="module")
+def rentals():
+    """
+    Rentals in no particular order of id, as read from the workbook: the ids of the previous rentals are floats
+    (NaN for a first rental), some point to a rental missing from the log, and some checkout delays are unknown.
+    """
+    rng = np.random.default_rng(0)
+    n = 400
+    rental_ids = rng.permutation(np.arange(500_000, 500_000 + 3 * n, 3))[:n]
+    previous_ids = rng.choice(rental_ids, n).astype(float)
+    previous_ids[rng.random(n) < 0.4] = np.nan
+    previous_ids[:10] = rental_ids.max() + np.arange(1, 11)  # not in the log
+    delays = rng.integers(-300, 900, n).astype(float)
+    delays[rng.random(n) < 0.15] = np.nan
+    time_delta = np.where(np.isnan(previous_ids), np.nan, rng.choice(np.arange(0, 750, 30), n))
+    return pd.DataFrame({
+        "rental_id": rental_ids,
+        "checkin_type": rng.choice(["connect", "mobile"], n),
+        "delay_at_checkout_in_minutes": delays,
+        "previous_ended_rental_id": previous_ids,
+        "time_delta_with_previous_rental_in_minutes": time_delta,
+    })
+
+
+def reference_features(rentals):
+    data = rentals.copy()
+    data['previous_ended_rental_id'] = data['previous_ended_rental_id'].astype('Int64', errors = 'ignore').astype(str)
+    data['rental_id'] = data['rental_id'].astype(str)
+    df2 = data[['rental_id', 'delay_at_checkout_in_minutes']]
+    df2 = df2.rename(columns={'rental_id': 'previous_ended_rental_id',
+                              'delay_at_checkout_in_minutes': 'previous_drivers_delay_in_mins'})
+    data = pd.merge(data, df2, on='previous_ended_rental_id', how='left')
+    data['minutes_passed_checkin_time'] = data['previous_drivers_delay_in_mins'] - data['time_delta_with_previous_rental_in_minutes']
+
+    def is_late(x):
+        if x > 0:
+            return "late"
+        elif x < 0:
+            return "not late"
+        else:
+            return np.nan
+    data['is_late_for_next_checkin'] = data['minutes_passed_checkin_time'].apply(is_late)
+    return data
+
+
+def assert_same_features(actual, expected):
+    for column in ["previous_drivers_delay_in_mins", "minutes_passed_checkin_time"]:
+        np.testing.assert_array_equal(actual[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float),
+                                      err_msg=column)
+    np.testing.assert_array_equal(actual["is_late_for_next_checkin"].fillna("unknown").to_numpy(),
+                                  expected["is_late_for_next_checkin"].fillna("unknown").to_numpy())
+
+
+def test_edge_cases_present(rentals):
+    previous_ids = rentals["previous_ended_rental_id"]
+    assert previous_ids.isna().any()
+    assert (~previous_ids.dropna().isin(rentals["rental_id"])).any()
+    assert previous_ids.isin(rentals.loc[rentals["delay_at_checkout_in_minutes"].isna(), "rental_id"]).any()
+    assert not rentals["rental_id"].is_monotonic_increasing
+
+
+def test_add_features(rentals):
+    actual, expected = add_features(rentals), reference_features(rentals)
+    assert_same_features(actual, expected)
+    assert set(actual["is_late_for_next_checkin"].dropna()) == {"late", "not late"}
+
+
+def test_iter_features(rentals):
+    # chunks looked up in the rentals of the whole log, not only in their own
+    def read_chunks():
+        return (rentals.iloc[start:start + 64] for start in range(0, len(rentals), 64))
+
+    actual = pd.concat(list(iter_features(read_chunks)))
+    assert_same_features(actual, reference_features(rentals))
+
+
+def test_lookup(rentals):
+    previous = PreviousRentals(rentals["rental_id"], rentals["delay_at_checkout_in_minutes"])
+    delays = rentals.set_index("rental_id")["delay_at_checkout_in_minutes"]
+    some = rentals["rental_id"].iloc[[5, 0, 5]].tolist()
+    np.testing.assert_array_equal(previous.lookup(some + [None, 1, 10**12]), delays[some].tolist() + [np.nan] * 3)
+    # nothing to look up in
+    np.testing.assert_array_equal(PreviousRentals([], []).lookup(some + [None]), [np.nan] * 4)
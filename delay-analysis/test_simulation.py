@@ -0,0 +1,200 @@
+"""
+DelaySimulation against the loops the dashboard used to compute its curves with (kept below as the reference),
+on a small fixed set of rentals.
+
+    cd delay-analysis && python -m pytest
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from delay_analysis.simulation import SCOPES, DelaySimulation, SensitivityGrid, _bootstrap_curves, process_pool
+
+FLEXIBILITIES = [0, 10, 60, 180, 720]
+
+
+@pytest.fixture(scope="module")
+def data():
+    """
+    Rentals with the edge cases of the real log: no previous rental (NaN time delta), unknown previous delay,
+    a time delta of 0 minutes, a car back exactly at the next checkin (0 minutes passed, neither late nor not late),
+    and delays and time deltas on multiples of 30 minutes, so that many of them equal a threshold.
+    """
+    rng = np.random.default_rng(0)
+    n = 300
+    time_delta = rng.choice(np.arange(0, 750, 30), n).astype(float)
+    time_delta[rng.random(n) < 0.3] = np.nan
+    previous_delay = rng.choice(np.arange(-300, 900, 15), n).astype(float)
+    previous_delay[rng.random(n) < 0.1] = np.nan
+    previous_delay[:10] = time_delta[:10]  # back exactly at the next checkin (or NaN)
+    time_delta[10:15] = 0
+    frame = pd.DataFrame({
+        "checkin_type": rng.choice(["connect", "mobile"], n, p=[0.2, 0.8]),
+        "time_delta_with_previous_rental_in_minutes": time_delta,
+        "previous_drivers_delay_in_mins": previous_delay,
+    })
+    minutes_passed = frame["previous_drivers_delay_in_mins"] - frame["time_delta_with_previous_rental_in_minutes"]
+    frame["is_late_for_next_checkin"] = minutes_passed.apply(
+        lambda x: "late" if x > 0 else "not late" if x < 0 else np.nan)
+    return frame
+
+
+def reference_solved(data):
+    df_pb = data[data['is_late_for_next_checkin'] == 'late']
+    solved, solved_c, solved_m = [], [], []
+    for threshold in range(501):
+        solved.append(df_pb[df_pb['previous_drivers_delay_in_mins'] < threshold].shape[0])
+        solved_c.append(df_pb[(df_pb['checkin_type'] == 'connect') & (df_pb['previous_drivers_delay_in_mins'] < threshold)].shape[0])
+        solved_m.append(df_pb[(df_pb['checkin_type'] == 'mobile') & (df_pb['previous_drivers_delay_in_mins'] < threshold)].shape[0])
+    return {"all": solved, "connect": solved_c, "mobile": solved_m}
+
+
+def reference_affected(data, flex):
+    df_affected_c = data[(data['checkin_type'] == 'connect') & (data['time_delta_with_previous_rental_in_minutes'].notna())]
+    df_affected_m = data[(data['checkin_type'] == 'mobile') & (data['time_delta_with_previous_rental_in_minutes'].notna())]
+    affected, affected_c, affected_m = [], [], []
+    for threshold in range(801):
+        affected.append(data[data['time_delta_with_previous_rental_in_minutes'] + flex < threshold].shape[0])
+        affected_c.append(df_affected_c[df_affected_c['time_delta_with_previous_rental_in_minutes'] + flex < threshold].shape[0])
+        affected_m.append(df_affected_m[df_affected_m['time_delta_with_previous_rental_in_minutes'] + flex < threshold].shape[0])
+    return {"all": affected, "connect": affected_c, "mobile": affected_m}
+
+
+def reference_profit(data, item):
+    df_affected = data[data['is_late_for_next_checkin'].notna()]
+    df_affected_c = data[(data['checkin_type'] == 'connect') & (data['is_late_for_next_checkin'].notna())]
+    df_affected_m = data[(data['checkin_type'] == 'mobile') & (data['is_late_for_next_checkin'].notna())]
+    not_late_c = len(df_affected_c[df_affected_c['is_late_for_next_checkin'] == 'not late'])
+    not_late_m = len(df_affected_m[df_affected_m['is_late_for_next_checkin'] == 'not late'])
+
+    profit, profit_c, profit_m = [], [], []
+    for threshold in range(801):
+        still_rent = df_affected[df_affected['time_delta_with_previous_rental_in_minutes'] + item >= threshold]
+        still_c = df_affected_c[df_affected_c['time_delta_with_previous_rental_in_minutes'] + item >= threshold]
+        still_m = df_affected_m[df_affected_m['time_delta_with_previous_rental_in_minutes'] + item >= threshold]
+        profit.append(len(still_rent[(still_rent['previous_drivers_delay_in_mins'] < threshold) |
+                                     (still_rent['previous_drivers_delay_in_mins'] < still_rent['time_delta_with_previous_rental_in_minutes'])]))
+        profit_c.append(len(still_c[(still_c['previous_drivers_delay_in_mins'] < threshold) |
+                                    (still_c['previous_drivers_delay_in_mins'] < still_c['time_delta_with_previous_rental_in_minutes'])]) + not_late_m)
+        profit_m.append(len(still_m[(still_m['previous_drivers_delay_in_mins'] < threshold) |
+                                    (still_m['previous_drivers_delay_in_mins'] < still_m['time_delta_with_previous_rental_in_minutes'])]) + not_late_c)
+    return {"all": profit, "connect": profit_c, "mobile": profit_m}
+
+
+def assert_curves(actual, expected):
+    assert set(actual) == set(SCOPES)
+    for scope in SCOPES:
+        np.testing.assert_array_equal(actual[scope], expected[scope], err_msg=scope)
+
+
+def test_edge_cases_present(data):
+    assert data["time_delta_with_previous_rental_in_minutes"].isna().any()
+    assert data["previous_drivers_delay_in_mins"].isna().any()
+    assert (data["time_delta_with_previous_rental_in_minutes"] == 0).any()
+    assert (data["previous_drivers_delay_in_mins"] == data["time_delta_with_previous_rental_in_minutes"]).any()
+    assert set(data["is_late_for_next_checkin"].dropna()) == {"late", "not late"}
+
+
+def test_solved(data):
+    assert_curves(DelaySimulation.from_frame(data).solved(np.arange(501)), reference_solved(data))
+
+
+@pytest.mark.parametrize("flexibility", FLEXIBILITIES)
+def test_affected(data, flexibility):
+    assert_curves(DelaySimulation.from_frame(data).affected(np.arange(801), flexibility),
+                  reference_affected(data, flexibility))
+
+
+@pytest.mark.parametrize("flexibility", FLEXIBILITIES)
+def test_profit(data, flexibility):
+    assert_curves(DelaySimulation.from_frame(data).profit(np.arange(801), flexibility),
+                  reference_profit(data, flexibility))
+
+
+@pytest.mark.parametrize("flexibility", FLEXIBILITIES)
+def test_best_threshold(data, flexibility):
+    # every whole minute up to beyond the largest time delta + flexibility: the first argmax is the smallest best one
+    thresholds = np.arange(1500)
+    profit = DelaySimulation.from_frame(data).profit(thresholds, flexibility)
+    options = {option["scope"]: option for option in DelaySimulation.from_frame(data).policy_options(flexibility)}
+    for scope in SCOPES:
+        best = int(np.argmax(profit[scope]))
+        assert options[scope]["thresholds"][scope if scope != "all" else "connect"] == thresholds[best], scope
+        assert options[scope]["successful"] == profit[scope][best], scope
+
+
+@pytest.mark.parametrize("metric, reference", [("affected", reference_affected), ("profit", reference_profit)])
+def test_sensitivity_grid(data, metric, reference):
+    expected = {flexibility: reference(data, flexibility) for flexibility in FLEXIBILITIES}
+    grid = SensitivityGrid(DelaySimulation.from_frame(data), metric, np.arange(801), FLEXIBILITIES)
+    # rows asked for in any order are the curves of the reference loops, computed once
+    for flexibility in [60, 0, 720, 60]:
+        assert_curves(grid.get(flexibility), expected[flexibility])
+    assert grid.filled.tolist() == [True, False, True, False, True]
+
+    values = grid.fill()
+    assert grid.filled.all() and values.shape == (len(FLEXIBILITIES), 801, len(SCOPES))
+    for i, flexibility in enumerate(FLEXIBILITIES):
+        for k, scope in enumerate(SCOPES):
+            np.testing.assert_array_equal(values[i, :, k], expected[flexibility][scope], err_msg=f"{flexibility} {scope}")
+
+
+def test_sensitivity_grid_unknown_flexibility(data):
+    grid = SensitivityGrid(DelaySimulation.from_frame(data), "profit", np.arange(801), FLEXIBILITIES)
+    for flexibility in [5, -1, 1000]:
+        with pytest.raises(ValueError, match="not in the grid"):
+            grid.get(flexibility)
+    assert not grid.filled.any()
+
+
+def resample(data, counts):
+    """The consecutive rentals, each one repeated as many times as it is drawn by a bootstrap resample."""
+    consecutive = data[data["time_delta_with_previous_rental_in_minutes"].notna()]
+    return consecutive.loc[consecutive.index.repeat(counts)]
+
+
+def test_bootstrap_resamples(data):
+    # each resample gives the curves of the reference loops on the rentals it draws
+    simulation = DelaySimulation.from_frame(data)
+    n = len(simulation.consecutive[1])
+    solved, profit = _bootstrap_curves(*simulation.consecutive, np.arange(801), 60, 3, 7)
+    weights = np.random.default_rng(7).multinomial(n, np.full(n, 1.0 / n), size=3)
+    for i, counts in enumerate(weights):
+        rentals = resample(data, counts)
+        assert_curves({scope: solved[scope][i][:501] for scope in SCOPES}, reference_solved(rentals))
+        assert_curves({scope: profit[scope][i] for scope in SCOPES}, reference_profit(rentals, 60))
+
+
+def test_bootstrap_bands(data):
+    simulation = DelaySimulation.from_frame(data)
+    thresholds = np.arange(0, 801, 20)
+    bands = simulation.bootstrap(thresholds, 60, n_resamples=40, confidence=0.8, workers=1, seed=3, chunk_size=15)
+
+    # the percentiles of the curves of the resamples drawn from the same seeds, chunk by chunk
+    n = len(simulation.consecutive[1])
+    curves = {"solved": {scope: [] for scope in SCOPES}, "profit": {scope: [] for scope in SCOPES}}
+    for size, seed in zip([15, 15, 10], np.random.SeedSequence(3).spawn(3)):
+        for counts in np.random.default_rng(seed).multinomial(n, np.full(n, 1.0 / n), size=size):
+            rentals = DelaySimulation.from_frame(resample(data, counts))
+            for curve, values in (("solved", rentals.solved(thresholds)), ("profit", rentals.profit(thresholds, 60))):
+                for scope in SCOPES:
+                    curves[curve][scope].append(values[scope])
+    for curve in ("solved", "profit"):
+        for scope in SCOPES:
+            low, high = np.percentile(curves[curve][scope], [10, 90], axis=0)
+            np.testing.assert_allclose(bands[curve][scope][0], low, err_msg=f"{curve} {scope}")
+            np.testing.assert_allclose(bands[curve][scope][1], high, err_msg=f"{curve} {scope}")
+            assert (low <= high).all()
+
+
+def test_bootstrap_same_result_in_a_pool(data):
+    simulation = DelaySimulation.from_frame(data)
+    thresholds = np.arange(0, 801, 20)
+    expected = simulation.bootstrap(thresholds, 60, n_resamples=50, workers=1, seed=5, chunk_size=10)
+    with process_pool(2) as pool:
+        results = [simulation.bootstrap(thresholds, 60, n_resamples=50, seed=5, chunk_size=10, pool=pool),
+                   simulation.bootstrap(thresholds, 60, n_resamples=50, workers=2, seed=5, chunk_size=10)]
+    for bands in results:
+        for curve in ("solved", "profit"):
+            for scope in SCOPES:
+                np.testing.assert_array_equal(bands[curve][scope], expected[curve][scope], err_msg=f"{curve} {scope}")
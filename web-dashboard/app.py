@@ -3,7 +3,9 @@ import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
-from PIL import Image
+from plotly.subplots import make_subplots
+from delay_analysis.simulation import DelaySimulation, SensitivityGrid, process_pool
+from delay_analysis.delay_data import DATA_URL, add_features, delay_histograms, load_sheets, source_version
 
 ### Config
 st.set_page_config(
@@ -13,8 +15,6 @@ st.set_page_config(
 )
 
 
-DATA_URL = ("https://jedha-getaround-project.s3.amazonaws.com/get_around_delay_analysis.xlsx")
-
 st.title("GetAround Delay Analysis Web Dashboard🚗 ")
 
 st.markdown("""
@@ -44,18 +44,69 @@ st.markdown("""
 
 """)
 
+@st.cache_data(ttl=300, show_spinner=False)
+def data_version(source):
+    # ETag of the file on S3, checked at most every 5 minutes
+    return source_version(source)
+
 @st.cache_data
-def load_data():
-    data = pd.read_excel(DATA_URL, sheet_name='rentals_data')
-    
-    data['previous_ended_rental_id'] = data['previous_ended_rental_id'].astype('Int64', errors = 'ignore').astype(str)
-    data['rental_id'], data['car_id'] = data['rental_id'].astype(str), data['car_id'].astype(str)
-    return data
+def load_data(source, version):
+    # version is only part of the cache key: a new file on S3 means new data
+    rentals, metadata = load_sheets(source, version)
+    return add_features(rentals), metadata
+
+@st.cache_resource(show_spinner=False)
+def delay_simulation(source, version):
+    # sorted arrays of the curves, built once per data version and shared by all sessions and reruns
+    return DelaySimulation.from_frame(load_data(source, version)[0])
+
+@st.cache_resource(show_spinner=False)
+def bootstrap_pool():
+    # started once and shared by all sessions, not forked from the threads of the server on every new flexibility
+    return process_pool()
+
+@st.cache_data(show_spinner="Computing confidence bands ...")
+def confidence_bands(source, version, flexibility):
+    # 1000 bootstrap resamples computed by the process pool, once per data version and flexibility
+    return delay_simulation(source, version).bootstrap(np.arange(801), flexibility, n_resamples=1000,
+                                                       pool=bootstrap_pool())
+
+def add_bands(fig, bands, x):
+    # shaded band between the low and high curves of each scope, in the color of its line
+    colors = {'all': '99, 110, 250', 'connect': '239, 85, 59', 'mobile': '0, 204, 150'}
+    for scope, (low, high) in bands.items():
+        fig.add_trace(go.Scatter(x=x, y=high[:len(x)], mode='lines', line=dict(width=0), showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scatter(x=x, y=low[:len(x)], mode='lines', line=dict(width=0), fill='tonexty',
+                                 fillcolor=f'rgba({colors[scope]}, 0.2)', name=f'90% band ({scope})', hoverinfo='skip'))
+
+# 30 minute bins: the previous driver's delay is clipped to +-12 hours, time deltas go up to 12 hours
+DELAY_EDGES = np.arange(-720, 721, 30)
+TIME_DELTA_EDGES = np.arange(0, 721, 30)
+
+@st.cache_data(show_spinner=False)
+def delay_views(source, version):
+    # binned counts instead of one point per rental, so the charts have the same size for any number of rentals
+    data = load_data(source, version)[0]
+    histograms = delay_histograms(data, DELAY_EDGES, TIME_DELTA_EDGES)
+    time_delta = data['time_delta_with_previous_rental_in_minutes'].to_numpy(dtype=float)
+    late_counts = {value: np.histogram(time_delta[data['is_late_for_next_checkin'].to_numpy() == value], TIME_DELTA_EDGES)[0]
+                   for value in ['not late', 'late']}
+    return histograms, late_counts
+
+@st.cache_resource(show_spinner=False)
+def sensitivity_grids(source, version):
+    # shared by all sessions: a flexibility computed once is a lookup for everyone until the data changes
+    simulation = delay_simulation(source, version)
+    return {
+        'affected': SensitivityGrid(simulation, 'affected', np.arange(801), np.arange(801)),
+        'profit': SensitivityGrid(simulation, 'profit', np.arange(801), np.arange(721)),
+    }
 
 st.subheader("Load and showcase data")
 
 data_load_state = st.text('Loading data ...')
-data = load_data()
+version = data_version(DATA_URL)
+data, metadata = load_data(DATA_URL, version)
 data_load_state.text("")
 
 if st.checkbox('Show raw data'):
@@ -64,7 +115,6 @@ if st.checkbox('Show raw data'):
 
 
 st.subheader("Let's find out what each variable means")
-metadata = pd.read_excel(DATA_URL, sheet_name='Documentation')
 pd.set_option('display.max_colwidth', None)
 st.write(metadata)
 
@@ -82,7 +132,6 @@ st.markdown("""
 st.subheader("Share of Consecutive Rentals")
 st.markdown("""This graph shows the number and percentage of rentals which are followed
 by another rental for the same vehicle within the next 12 hours after the anticipated checkout time. """)
-data['second_rental'] = np.where(data['time_delta_with_previous_rental_in_minutes'].isna(), 0, 1)
 df = data.groupby(['second_rental'])['second_rental'].count().reset_index(name='count')
 fig = px.pie(df, values='count', names='second_rental')
 st.plotly_chart(fig, height = 600, use_container_width=True)
@@ -118,20 +167,6 @@ This is nearly 25% of the cases!
 
 
 st.subheader("How often are drivers late for the next check-in?")
-df2 = data[['rental_id', 'delay_at_checkout_in_minutes']]
-df2 = df2.rename(columns={'rental_id': 'previous_ended_rental_id', 
-                          'delay_at_checkout_in_minutes': 'previous_drivers_delay_in_mins'})
-data = pd.merge(data, df2, on='previous_ended_rental_id', how='left')
-data['minutes_passed_checkin_time'] = data['previous_drivers_delay_in_mins'] - data['time_delta_with_previous_rental_in_minutes']
-
-def is_late(x):
-    if x > 0:
-        return "late"
-    elif x < 0:
-        return "not late"
-    else:
-        return np.nan
-data['is_late_for_next_checkin'] = data['minutes_passed_checkin_time'].apply(is_late)
 df = data[data['is_late_for_next_checkin'].isna()==False]
 df = df.groupby(['is_late_for_next_checkin'])['is_late_for_next_checkin'].count().reset_index(name='count')
 fig = px.pie(df, values='count', names='is_late_for_next_checkin')
@@ -146,9 +181,22 @@ check-in 218 times, which makes near 12% of the cases of consecutive rentals.
 """)
             
 st.subheader('How does this impact the next driver?')
-image = Image.open('swarmplot.png')
-col1, col2, col3 = st.columns([1.5, 5, 1.5])
-col2.image(image, caption='Cancelation by the delay time')
+histograms, late_counts = delay_views(DATA_URL, version)
+bin_centers = TIME_DELTA_EDGES[:-1] + 15
+fig = make_subplots(rows=1, cols=2, shared_yaxes=True, subplot_titles=['Ended rentals', 'Canceled rentals'])
+for col, state in enumerate(['ended', 'canceled'], start=1):
+    fig.add_trace(go.Heatmap(z=histograms[state], x=bin_centers, y=DELAY_EDGES[:-1] + 15, coloraxis='coloraxis',
+                             hovertemplate='time delta %{x} mins<br>previous delay %{y} mins<br>%{z} rentals<extra></extra>'),
+                  row=1, col=col)
+    # above this line the car was returned after the next check-in time
+    fig.add_trace(go.Scatter(x=[0, 720], y=[0, 720], mode='lines', line=dict(color='grey', dash='dash'), showlegend=False),
+                  row=1, col=col)
+fig.update_xaxes(title='Time delta with the previous rental (mins)')
+fig.update_yaxes(title="Previous driver's checkout delay (mins)", col=1)
+fig.update_layout(coloraxis=dict(colorscale='Blues'), height=500)
+st.plotly_chart(fig, use_container_width=True)
+st.caption("""Number of consecutive rentals per 30 minutes bin of time delta and previous driver's delay (clipped to 12 hours),
+for the rentals that ended and the ones that were canceled. Above the dashed line the car was late for the next check-in.""")
       
 st.markdown("""
 - In the most cases of consecutive rentals, vehicles were returned between 14 hours before to 
@@ -202,12 +250,10 @@ st.markdown("""
 
 col1, col2 = st.columns(2)
 with col1:
-    fig = px.strip(df, x='time_delta_with_previous_rental_in_minutes', y='is_late_for_next_checkin',
-                 title='Checkout Delays and Time Delta',
-                 labels={'time_delta_with_previous_rental_in_minutes': 'Time Delta between Checkouts', 
-                         'is_late_for_next_checkin': 'Is the Previous Renter Late for Checkout'},
-                 hover_name='is_late_for_next_checkin', color = 'is_late_for_next_checkin',
-                 width=800, height=400)
+    fig = go.Figure([go.Bar(x=bin_centers, y=late_counts[value], name=value) for value in ['not late', 'late']])
+    fig.update_layout(title='Checkout Delays and Time Delta', barmode='stack', width=800, height=400,
+                      xaxis_title='Time Delta between Checkouts',
+                      yaxis_title='Number of rentals', legend_title='Is the Previous Renter Late for Checkout')
     st.plotly_chart(fig, use_container_width=True)
     st.markdown("""
 By looking at the figure above we can derive that increasing the time interval between two consecutive rentals 
@@ -216,8 +262,7 @@ might have indeed decreased the number of returns late for the next check-in in
 
 with col2:
     df = data.copy()
-    df['is_late_for_next_checkin_binary'] = df['is_late_for_next_checkin'].fillna('not late').apply(lambda x: x if
-                                                                                                     x == 'late' else 'not late or no info')
+    df['is_late_for_next_checkin_binary'] = np.where(df['is_late_for_next_checkin'] == 'late', 'late', 'not late or no info')
     df = df.groupby(['is_late_for_next_checkin_binary'])['is_late_for_next_checkin_binary'].count().reset_index(name='count')
     fig = px.pie(df, values='count', names='is_late_for_next_checkin_binary')
     st.plotly_chart(fig, use_container_width=True)
@@ -239,27 +284,17 @@ Our goal is to find a threshold and scope such that:
 ### First, let's find out how many problematic case can be solved by each threshold and scope:
 """
 )
-df_pb = data[data['is_late_for_next_checkin'] == 'late']
-
-solved = []
-solved_c = []
-solved_m = []
-
-for threshold in range(501):
-    count = df_pb[df_pb['previous_drivers_delay_in_mins'] < threshold].shape[0]
-    count_c = df_pb[(df_pb['checkin_type'] == 'connect') & (df_pb['previous_drivers_delay_in_mins'] < threshold)].shape[0]
-    count_m = df_pb[(df_pb['checkin_type'] == 'mobile') & (df_pb['previous_drivers_delay_in_mins'] < threshold)].shape[0]
-    solved.append(count)
-    solved_c.append(count_c)
-    solved_m.append(count_m)
+# Sorted delays and time deltas of each scope, shared by all the threshold curves below
+simulation = delay_simulation(DATA_URL, version)
+solved = simulation.solved(np.arange(501))
 
 # Convert range to a list for 'x' argument
 x_values = list(range(501))
 
 # Create traces for each line
-trace1 = go.Scatter(x=x_values, y=solved, mode='lines', name='All cars')
-trace2 = go.Scatter(x=x_values, y=solved_c, mode='lines', name='Connect cars')
-trace3 = go.Scatter(x=x_values, y=solved_m, mode='lines', name='Mobile cars')
+trace1 = go.Scatter(x=x_values, y=solved['all'], mode='lines', name='All cars')
+trace2 = go.Scatter(x=x_values, y=solved['connect'], mode='lines', name='Connect cars')
+trace3 = go.Scatter(x=x_values, y=solved['mobile'], mode='lines', name='Mobile cars')
 
 # Create layout for the plot
 layout = go.Layout(
@@ -272,6 +307,9 @@ layout = go.Layout(
 
 # Create figure and add traces to it
 fig = go.Figure(data=[trace1, trace2, trace3], layout=layout)
+show_bands = st.checkbox('Show 90% bootstrap confidence bands of the curves (resampling the consecutive rentals)')
+if show_bands:
+    add_bands(fig, confidence_bands(DATA_URL, version, 0)['solved'], x_values)
 st.plotly_chart(fig, width = 800, height = 600)
 
 st.markdown("""
@@ -299,26 +337,13 @@ st.markdown("""
 Following graph shows the number of rentals that would not have been available for a pick-up at the time demanded by the 
 user had we deployed the selected level of minimum threshold when displaying the available cars on our app.
 """)
-affected_count = []
-affected_count_c = []
-affected_count_m = []
-
-df_affected = data[data['time_delta_with_previous_rental_in_minutes'].notna()]
-df_affected_c = data[(data['checkin_type'] == 'connect') & (data['time_delta_with_previous_rental_in_minutes'].notna())]
-df_affected_m = data[(data['checkin_type'] == 'mobile') & (data['time_delta_with_previous_rental_in_minutes'].notna())]
-
-for threshold in range(801):
-    count = data[data['time_delta_with_previous_rental_in_minutes'] < threshold].shape[0]
-    affected_count.append(count)
-    count_c = df_affected_c[df_affected_c['time_delta_with_previous_rental_in_minutes'] < threshold].shape[0]
-    affected_count_c.append(count_c)
-    count_m = df_affected_m[df_affected_m['time_delta_with_previous_rental_in_minutes'] < threshold].shape[0]
-    affected_count_m.append(count_m)
+grids = sensitivity_grids(DATA_URL, version)
+affected = grids['affected'].get(0)
 
 # Create traces for each line
-trace1 = go.Scatter(x=list(range(801)), y=affected_count, mode='lines', name='All cars')
-trace2 = go.Scatter(x=list(range(801)), y=affected_count_c, mode='lines', name='Connect cars')
-trace3 = go.Scatter(x=list(range(801)), y=affected_count_m, mode='lines', name='Mobile cars')
+trace1 = go.Scatter(x=list(range(801)), y=affected['all'], mode='lines', name='All cars')
+trace2 = go.Scatter(x=list(range(801)), y=affected['connect'], mode='lines', name='Connect cars')
+trace3 = go.Scatter(x=list(range(801)), y=affected['mobile'], mode='lines', name='Mobile cars')
 
 # Create layout for the plot
 layout = go.Layout(
@@ -350,23 +375,12 @@ then see how many of our bookings we would have lost on each threshold for the f
 """
 )
 flex = st.slider('How many minutes you think users can be flexible about their preferred pick-up time', 0, 800, 10)
-affected_count = []
-affected_count_c = []
-affected_count_m = []
-
-
-for threshold in range(801):
-    count = data[data['time_delta_with_previous_rental_in_minutes'] + flex < threshold].shape[0]
-    affected_count.append(count)
-    count_c = df_affected_c[df_affected_c['time_delta_with_previous_rental_in_minutes'] + flex < threshold].shape[0]
-    affected_count_c.append(count_c)
-    count_m = df_affected_m[df_affected_m['time_delta_with_previous_rental_in_minutes'] + flex < threshold].shape[0]
-    affected_count_m.append(count_m)
+affected = grids['affected'].get(flex)
 
 # Create traces for each line
-trace1 = go.Scatter(x=list(range(801)), y=affected_count, mode='lines', name='All cars')
-trace2 = go.Scatter(x=list(range(801)), y=affected_count_c, mode='lines', name='Connect cars')
-trace3 = go.Scatter(x=list(range(801)), y=affected_count_m, mode='lines', name='Mobile cars')
+trace1 = go.Scatter(x=list(range(801)), y=affected['all'], mode='lines', name='All cars')
+trace2 = go.Scatter(x=list(range(801)), y=affected['connect'], mode='lines', name='Connect cars')
+trace3 = go.Scatter(x=list(range(801)), y=affected['mobile'], mode='lines', name='Mobile cars')
 
 # Create layout for the plot
 layout = go.Layout(
@@ -413,41 +427,13 @@ item = st.slider('How many minutes users can have flexible about their preferred
 
 fig = go.Figure()
 
-df_affected = data[data['is_late_for_next_checkin'].notna()]
-df_affected_c = data[(data['checkin_type'] == 'connect') & (data['is_late_for_next_checkin'].notna())]
-df_affected_m = data[(data['checkin_type'] == 'mobile') & (data['is_late_for_next_checkin'].notna())]
-
-not_late_c = len(df_affected_c[df_affected_c['is_late_for_next_checkin'] == 'not late'])
-not_late_m = len(df_affected_m[df_affected_m['is_late_for_next_checkin'] == 'not late'])
-
-
-profit_count = []
-profit_count_c = []
-profit_count_m = []
-
-for threshold in range(801):
-    still_rent = df_affected[df_affected['time_delta_with_previous_rental_in_minutes'] + item >= threshold]
-    still_c = df_affected_c[df_affected_c['time_delta_with_previous_rental_in_minutes'] + item >= threshold]
-    still_m = df_affected_m[df_affected_m['time_delta_with_previous_rental_in_minutes'] + item >= threshold]
+profit = grids['profit'].get(item)
 
-    gain = len(still_rent[
-        (still_rent['previous_drivers_delay_in_mins'] < threshold) |
-        (still_rent['previous_drivers_delay_in_mins'] < still_rent['time_delta_with_previous_rental_in_minutes'])
-    ])
-
-    gain_c = len(still_c[(still_c['previous_drivers_delay_in_mins'] < threshold) |
-                         (still_c['previous_drivers_delay_in_mins'] < still_c['time_delta_with_previous_rental_in_minutes'])]) + not_late_m
-
-    gain_m = len(still_m[(still_m['previous_drivers_delay_in_mins'] < threshold) |
-                         (still_m['previous_drivers_delay_in_mins'] < still_m['time_delta_with_previous_rental_in_minutes'])]) + not_late_c
-
-    profit_count.append(gain)
-    profit_count_c.append(gain_c)
-    profit_count_m.append(gain_m)
-
-fig.add_trace(go.Scatter(x=list(range(801)), y=profit_count, mode='lines', name='All cars'))
-fig.add_trace(go.Scatter(x=list(range(801)), y=profit_count_c, mode='lines', name='Connect cars'))
-fig.add_trace(go.Scatter(x=list(range(801)), y=profit_count_m, mode='lines', name='Mobile cars'))
+fig.add_trace(go.Scatter(x=list(range(801)), y=profit['all'], mode='lines', name='All cars'))
+fig.add_trace(go.Scatter(x=list(range(801)), y=profit['connect'], mode='lines', name='Connect cars'))
+fig.add_trace(go.Scatter(x=list(range(801)), y=profit['mobile'], mode='lines', name='Mobile cars'))
+if show_bands:
+    add_bands(fig, confidence_bands(DATA_URL, version, item)['profit'], list(range(801)))
 fig.add_shape(type='line', x0=0, y0=len(data[data['is_late_for_next_checkin'] == 'not late']), x1=600, y1=len(data[data['is_late_for_next_checkin'] == 'not late']),
               line=dict(color='grey', dash='dash'), name='Current Number of Non-problematic Rentals')
 
@@ -455,6 +441,29 @@ fig.update_xaxes(title='Threshold', range=[0, 800], tickvals=list(range(0, 801,
 fig.update_yaxes(title='Number of non-problematic second rentals')
 fig.update_layout(title=f'Number of non-problematic second rentals if {item} mins of flexibility', showlegend=True)
 st.plotly_chart(fig, use_container_width=True, height = 1000) 
+
+st.subheader("Which threshold and scope maximize the non-problematic consecutive rentals?")
+st.markdown("""Instead of reading the curves by eye, the solver below finds the best threshold of each scope for the
+flexibility selected above. It only evaluates the thresholds where the curves can change (the observed time deltas
+and delays), so there is no limit to 800 minutes. A connect rental can be worth more than a mobile one: set its
+value relative to a mobile rental to weight the rentals of each type.""")
+col1, col2 = st.columns(2)
+with col1:
+    connect_value = st.number_input('Value of a connect rental (a mobile rental is worth 1)', 0.0, 10.0, 1.0, 0.1)
+with col2:
+    separate = st.checkbox('Also try separate thresholds for connect and mobile cars')
+options = simulation.policy_options(item, {'connect': connect_value}, separate)
+best = max(options, key=lambda option: option['value'])
+st.dataframe(pd.DataFrame([{'scope': option['scope'],
+                            'connect threshold': option['thresholds']['connect'],
+                            'mobile threshold': option['thresholds']['mobile'],
+                            'non-problematic consecutive rentals': option['successful'],
+                            'value': option['value']} for option in options]),
+             hide_index=True, use_container_width=True)
+st.markdown(f"""With {item} mins of flexibility, the best policy is the **{best['scope']}** scope with a threshold of
+**{best['thresholds']['connect']:g}** mins for connect cars and **{best['thresholds']['mobile']:g}** mins for mobile cars,
+for {best['successful']} non-problematic consecutive rentals.""")
+
 st.markdown("""
 ## Final remarks on threshold:
 - As one can expect all at the threshold 0, all graphs start from the same point which represent the current outcome.